@@ -0,0 +1,627 @@
+#!/usr/bin/python
+"""Load test for the weather bot
+
+Runs the weather bot against local stand-ins for the Jabber server's
+component (XEP-0114) port and for the Yahoo! Weather feeds, scripts a large
+number of simulated subscribers, and reports:
+
+- subscription, probe and message (forecast) round trip latencies,
+- refresh to presence delivered latencies, for feed updates broadcast to
+  every subscriber,
+- stanzas per second received from the bot.
+
+With --roster-memory, it instead compares the memory used by the interned
+roster and by a dictionary of sets of JIDs, for the given number of
+subscriptions.
+
+With --roster-save, it instead compares the cost of recording one
+subscription change by appending to the roster journal, and by rewriting
+the whole pickled roster as the bot originally did, for a roster of the
+given number of subscriptions.
+
+With --parse, it instead compares the time taken to parse the Yahoo! Weather
+feeds given as arguments (by default, the one in testdata) in one streaming
+pass, and with minidom as the bot originally did.
+
+Usage: loadtest.py [options] [feed...] (see loadtest.py --help)
+"""
+
+__license__ = """This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details."""
+
+import time
+import socket
+import threading
+import tempfile
+import shutil
+import os
+import gc
+import cPickle
+import hashlib
+import cgi
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import xml.parsers.expat
+from xml.dom import minidom
+from xml.sax.saxutils import quoteattr, escape
+from collections import deque
+from cStringIO import StringIO
+from optparse import OptionParser
+import xmpp
+import weatherbot
+
+FEED = """<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
+<rss version="2.0" xmlns:yweather="http://xml.weather.yahoo.com/ns/rss/1.0" xmlns:geo="http://www.w3.org/2003/01/geo/wgs84_pos#">
+<channel>
+<title>Yahoo! Weather - %(city)s, LT</title>
+<link>http://weather.yahoo.com/forecast/%(location)s.html</link>
+<ttl>60</ttl>
+<yweather:location city="%(city)s" region="" country="LT"/>
+<yweather:units temperature="C" distance="km" pressure="mb" speed="km/h"/>
+<yweather:wind chill="%(temp)d" direction="270" speed="19"/>
+<yweather:atmosphere humidity="69" visibility="24.14" pressure="1015.92" rising="0"/>
+<item>
+<title>Conditions for %(city)s, LT</title>
+<geo:lat>%(lat).2f</geo:lat>
+<geo:long>%(long).2f</geo:long>
+<link>http://weather.yahoo.com/forecast/%(location)s.html</link>
+<yweather:condition text="Version %(version)d" code="30" temp="%(temp)d" date="%(date)s"/>
+<description><![CDATA[Synthetic feed for load testing]]></description>
+<yweather:forecast day="Mon" date="17 Mar 2008" low="-6" high="3" text="Partly Cloudy" code="30"/>
+<yweather:forecast day="Tue" date="18 Mar 2008" low="-2" high="4" text="Snow" code="16"/>
+</item>
+</channel>
+</rss>
+"""
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server serving synthetic Yahoo! Weather feeds.
+
+    Every location has a version number, which is reflected in the feed
+    and its ETag; conditional requests for the current version get a
+    "304 Not Modified".
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FeedHandler)
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.requests = 0
+
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def bump(self):
+        """Change every feed."""
+        self.lock.acquire()
+        for location in self.versions:
+            self.versions[location] += 1
+        self.lock.release()
+
+    def feed(self, location):
+        """Returns the ETag and contents of the feed for a location."""
+        self.lock.acquire()
+        version = self.versions.setdefault(location, 0)
+        self.requests += 1
+        self.lock.release()
+        etag = '"%s-%d"' % (location, version)
+        n = hash(location)
+        data = FEED % {'city': escape(location), 'location': escape(location),
+                       'version': version, 'temp': n % 40 - 10 + version % 5,
+                       'lat': n % 180 - 90, 'long': (n // 180) % 360 - 180,
+                       'date': time.ctime()}
+        return (etag, data)
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        query = cgi.parse_qs(urlparse.urlsplit(self.path)[3])
+        (etag, data) = self.server.feed(query.get('p', [''])[0])
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class FakeComponentServer(threading.Thread):
+    """A stand-in for the Jabber server's component port.
+
+    Accepts one connection, completes the XEP-0114 handshake, and then
+    passes every stanza the bot sends to "on_stanza(name, attrs, status,
+    time)", where "status" is the text of a presence's status.
+    """
+    def __init__(self, secret, on_stanza):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.secret = secret
+        self.on_stanza = on_stanza
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.stream_id = 'loadtest%d' % time.time()
+        self.send_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.sock = None
+        self.depth = 0
+        self.stanza = None
+        self.text = None
+        self.status = None
+
+    def send(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.send_lock.acquire()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.send_lock.release()
+
+    def run(self):
+        (self.sock, addr) = self.listener.accept()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.characters
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            parser.Parse(data)
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            self.send("<?xml version='1.0'?><stream:stream xmlns='jabber:component:accept' xmlns:stream='http://etherx.jabber.org/streams' id=%s from=%s>"
+                      % (quoteattr(self.stream_id), quoteattr(attrs.get('to', ''))))
+        elif self.depth == 2:
+            self.stanza = (name, attrs)
+            self.text = []
+            self.status = None
+        elif self.depth == 3 and name == 'status':
+            self.status = []
+
+    def characters(self, data):
+        if self.depth == 2:
+            self.text.append(data)
+        elif self.depth == 3 and self.status is not None:
+            self.status.append(data)
+
+    def end_element(self, name):
+        if self.depth == 2:
+            now = time.time()
+            if name == 'handshake':
+                digest = hashlib.sha1(self.stream_id + self.secret).hexdigest()
+                if u''.join(self.text).strip() != digest:
+                    raise ValueError('component handshake failed')
+                self.send('<handshake/>')
+                self.ready.set()
+            else:
+                status = self.status and u''.join(self.status)
+                self.on_stanza(self.stanza[0], self.stanza[1], status, now)
+        self.depth -= 1
+
+class LoadTestWeather(weatherbot.YahooWeather):
+    """YahooWeather fetching from the local feed server.
+
+    The feed is polled every "poll_interval" seconds, and the time of each
+    refresh is added to the presence, so that the time taken to deliver it
+    can be measured.
+    """
+    poll_interval = 1
+
+    def __init__(self, opts):
+        weatherbot.YahooWeather.__init__(self, opts)
+        self.url = '%s/forecastrss?p=%s' % (opts['feedserver'], opts['location'])
+
+    def refresh(self):
+        if weatherbot.YahooWeather.refresh(self) is False:
+            return False
+        self.presence = xmpp.protocol.Presence(
+            status='%s\nrefreshed %.6f' % (self.presence.getStatus(), time.time()))
+
+    def next_update_time(self):
+        return time.time() + self.poll_interval
+
+def bare(jid):
+    return jid.split('/', 1)[0]
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class LoadTest:
+    """Drives the load test, and matches the bot's stanzas to the requests
+    that caused them.
+    """
+    def __init__(self, options):
+        self.options = options
+        self.cond = threading.Condition()
+        # (stanza name, type, to, from) -> deque of (kind, time sent)
+        self.pending = {}
+        self.latencies = {}
+        self.counts = {}
+        self.phase = None
+        self.first_update = None
+        self.last_update = None
+
+    def expect(self, kind, key, sent):
+        self.pending.setdefault(key, deque()).append((kind, sent))
+
+    def on_stanza(self, name, attrs, status, now):
+        key = (name, attrs.get('type'), bare(attrs.get('to', '')),
+               bare(attrs.get('from', '')))
+        self.cond.acquire()
+        try:
+            waiting = self.pending.get(key)
+            if waiting:
+                (kind, sent) = waiting.popleft()
+                self.latencies.setdefault(kind, []).append(now - sent)
+            elif self.phase == 'update' and name == 'presence' \
+                 and status and '\nrefreshed ' in status:
+                kind = 'update'
+                refreshed = float(status.rsplit('\nrefreshed ', 1)[1])
+                self.latencies.setdefault(kind, []).append(now - refreshed)
+                if self.first_update is None:
+                    self.first_update = now
+                self.last_update = now
+            else:
+                kind = '%s/%s' % (name, attrs.get('type', 'available'))
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            self.counts['total'] = self.counts.get('total', 0) + 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def count(self, kind):
+        return self.counts.get(kind, 0)
+
+    def wait_for(self, kind, n):
+        """Wait until "n" stanzas of the given kind have been received.
+        Returns False on timeout."""
+        deadline = time.time() + self.options.timeout
+        self.cond.acquire()
+        try:
+            while self.count(kind) < n:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print 'timed out waiting for %s: got %d of %d' \
+                          % (kind, self.count(kind), n)
+                    return False
+                self.cond.wait(remaining)
+            return True
+        finally:
+            self.cond.release()
+
+    def send_all(self, kind, requests):
+        """Send requests, given as (key, stanza) pairs, in one write."""
+        stanzas = []
+        self.cond.acquire()
+        now = time.time()
+        for (key, stanza) in requests:
+            self.expect(kind, key, now)
+            stanzas.append(stanza)
+        self.cond.release()
+        self.component.send(u''.join(stanzas))
+
+    def run(self):
+        options = self.options
+        self.feedserver = FeedServer()
+        feedthread = threading.Thread(target=self.feedserver.serve_forever)
+        feedthread.setDaemon(True)
+        feedthread.start()
+
+        self.component = FakeComponentServer('secret', self.on_stanza)
+        self.component.start()
+
+        spooldir = tempfile.mkdtemp(prefix='weatherbot-loadtest-')
+        weatherbot.jid = 'weather.loadtest'
+        weatherbot.server = '127.0.0.1'
+        weatherbot.port = self.component.port
+        weatherbot.password = 'secret'
+        weatherbot.spooldir = spooldir
+        weatherbot.feeds.max_age = 0
+        weatherbot.send_rate = options.send_rate
+        self.nodes = ['node%d' % i for i in xrange(options.nodes)]
+        for node in self.nodes:
+            weatherbot.bots[node] = {'LoadTest': (LoadTestWeather({'location': node,
+                                                                   'feedserver': self.feedserver.url()}),
+                                                  10)}
+
+        try:
+            start = time.time()
+            if options.shards:
+                updater = weatherbot.ShardSupervisor(options.shards)
+            else:
+                updater = weatherbot.WeatherUpdater(options.workers)
+            bot = weatherbot.WeatherBot(debug=[])
+            updater.start()
+            serve = threading.Thread(target=bot.serve)
+            serve.setDaemon(True)
+            serve.start()
+            self.component.ready.wait()
+            print 'startup: %.3fs for %d nodes' % (time.time() - start, options.nodes)
+
+            try:
+                self.run_phases()
+            finally:
+                updater.stop()
+        finally:
+            shutil.rmtree(spooldir, True)
+            self.feedserver.shutdown()
+
+    def run_phases(self):
+        options = self.options
+        domain = weatherbot.jid
+        users = [('user%d@load.test' % i, '%s@%s' % (self.nodes[i % len(self.nodes)], domain))
+                 for i in xrange(options.subscribers)]
+        start = time.time()
+
+        # subscriptions
+        self.phase = 'subscribe'
+        self.send_all('subscribe',
+                      [(('presence', 'subscribed', user, node),
+                        u"<presence type='subscribe' from=%s to=%s/>"
+                        % (quoteattr(user + '/load'), quoteattr(node)))
+                       for (user, node) in users])
+        self.wait_for('subscribe', len(users))
+        self.wait_for('presence/available', len(users))
+
+        # probes
+        self.phase = 'probe'
+        probes = users[:options.probes]
+        self.send_all('probe',
+                      [(('presence', None, user, node),
+                        u"<presence type='probe' from=%s to=%s/>"
+                        % (quoteattr(user), quoteattr(node)))
+                       for (user, node) in probes])
+        self.wait_for('probe', len(probes))
+
+        # forecast requests
+        self.phase = 'message'
+        messages = [users[i % len(users)] for i in xrange(options.messages)]
+        self.send_all('message',
+                      [(('message', 'chat', user, node),
+                        u"<message type='chat' from=%s to=%s><body>forecast</body></message>"
+                        % (quoteattr(user + '/load'), quoteattr(node)))
+                       for (user, node) in messages])
+        self.wait_for('message', len(messages))
+
+        # feed updates, broadcast to every subscriber
+        self.phase = 'update'
+        update_time = 0
+        for cycle in xrange(options.cycles):
+            expected = self.count('update') + len(users)
+            self.first_update = None
+            self.feedserver.bump()
+            if not self.wait_for('update', expected):
+                break
+            update_time += self.last_update - self.first_update
+
+        elapsed = time.time() - start
+        self.report(elapsed, update_time)
+
+    def report(self, elapsed, update_time):
+        print
+        print '%-10s %8s %10s %10s %10s %10s' % ('', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+        for kind in ('subscribe', 'probe', 'message', 'update'):
+            values = sorted(self.latencies.get(kind, []))
+            if not values:
+                continue
+            print '%-10s %8d %10.2f %10.2f %10.2f %10.2f' % (
+                kind, len(values), 1000 * percentile(values, 50),
+                1000 * percentile(values, 90), 1000 * percentile(values, 99),
+                1000 * values[-1])
+        print
+        if update_time > 0:
+            print 'presence broadcast: %.0f stanzas/s' % (self.count('update') / update_time)
+        print 'overall: %d stanzas in %.2fs (%.0f stanzas/s), %d feed requests' \
+              % (self.count('total'), elapsed, self.count('total') / elapsed,
+                 self.feedserver.requests)
+
+def rss():
+    """Returns the resident set size of this process, in bytes."""
+    fp = open('/proc/self/statm')
+    pages = int(fp.read().split()[1])
+    fp.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def measure_roster(kind, subscriptions, nodes, per_user):
+    """Builds a roster of the given kind, and returns its measurements.
+    Runs in a child process, so that memory freed by other measurements
+    does not get reused."""
+    users = subscriptions // per_user
+    gc.collect()
+    before = rss()
+    start = time.time()
+    if kind == 'interned':
+        roster = weatherbot.Roster()
+        add = roster.add
+    else:
+        roster = {}
+        add = lambda node, user: roster.setdefault(node, set()).add(user)
+    for i in xrange(users):
+        for j in xrange(per_user):
+            # as from a subscription stanza: a new string every time
+            add('node%d' % ((i + j * 7919) % nodes), u'user%d@load.test' % i)
+    build = time.time() - start
+    gc.collect()
+    memory = rss() - before
+
+    if kind == 'interned':
+        has = roster.has
+        subscribers = roster.subscribers
+    else:
+        has = lambda node, user: user in roster.get(node, ())
+        subscribers = lambda node: iter(roster.get(node, ()))
+    start = time.time()
+    for i in xrange(100000):
+        has('node%d' % (i % nodes), u'user%d@load.test' % i)
+    probe = (time.time() - start) / 100000
+    start = time.time()
+    for i in xrange(nodes):
+        for user in subscribers('node%d' % i):
+            pass
+    fanout = time.time() - start
+    start = time.time()
+    size = len(cPickle.dumps(roster, cPickle.HIGHEST_PROTOCOL))
+    dump = time.time() - start
+    return (memory, build, probe, fanout, size, dump)
+
+def roster_memory(options):
+    subscriptions = options.roster_memory
+    print '%d subscriptions, %d nodes, %d nodes per user' \
+          % (subscriptions, options.nodes, options.nodes_per_user)
+    print '%-10s %10s %10s %10s %10s %10s %10s' % ('', 'memory MB', 'build s',
+                                                  'probe us', 'fan-out s',
+                                                  'pickle MB', 'pickle s')
+    for kind in ('dict', 'interned'):
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(r)
+            result = measure_roster(kind, subscriptions, options.nodes,
+                                    options.nodes_per_user)
+            os.write(w, cPickle.dumps(result))
+            os._exit(0)
+        os.close(w)
+        fp = os.fdopen(r)
+        (memory, build, probe, fanout, size, dump) = cPickle.loads(fp.read())
+        fp.close()
+        os.waitpid(pid, 0)
+        print '%-10s %10.1f %10.2f %10.2f %10.3f %10.1f %10.2f' % (
+            kind, memory / 1048576.0, build, probe * 1e6, fanout,
+            size / 1048576.0, dump)
+
+def roster_save(options):
+    subscriptions = options.roster_save
+    users = subscriptions // options.nodes_per_user
+    roster = {}
+    for i in xrange(users):
+        for j in xrange(options.nodes_per_user):
+            roster.setdefault('node%d' % ((i + j * 7919) % options.nodes),
+                              set()).add(u'user%d@load.test' % i)
+    spooldir = tempfile.mkdtemp()
+    try:
+        weatherbot.spooldir = spooldir
+        # the original RosterStorage.save, once per change
+        saves = 5
+        start = time.time()
+        for i in xrange(saves):
+            fp = open(os.path.join(spooldir, 'roster'), 'w')
+            cPickle.dump(roster, fp)
+            fp.close()
+        full = (time.time() - start) / saves
+
+        storage = weatherbot.RosterStorage()
+        storage.save(weatherbot.Roster(roster))
+        # stay below the compaction threshold
+        events = min(10000, storage.compact_at - 1)
+        start = time.time()
+        for i in xrange(events):
+            if i % 2:
+                storage.discard('node0', u'new%d@load.test' % (i - 1))
+            else:
+                storage.add('node0', u'new%d@load.test' % i)
+        storage.close()
+        journal = (time.time() - start) / events
+    finally:
+        shutil.rmtree(spooldir)
+    print '%d subscriptions, %d nodes, %d nodes per user' \
+          % (subscriptions, options.nodes, options.nodes_per_user)
+    print 'full pickle: %.1f ms per change' % (full * 1e3)
+    print 'journal:     %.1f us per change (%d changes, fsync every %d)' \
+          % (journal * 1e6, events, storage.sync_records)
+
+def parse_yahoo_minidom(fp):
+    """Parses a Yahoo! Weather feed the way the bot originally did: into a
+    minidom tree, from which every value is looked up by tag name."""
+    doc = minidom.parse(fp)
+    feed = {'forecast': []}
+    for name in ('units', 'condition', 'wind', 'atmosphere', 'location'):
+        feed[name] = dict(doc.getElementsByTagName('yweather:%s' % name)[0].attributes.items())
+    for x in doc.getElementsByTagName('yweather:forecast'):
+        feed['forecast'].append(dict(x.attributes.items()))
+    feed['link'] = doc.getElementsByTagName('item')[0] \
+                      .getElementsByTagName('link')[0].firstChild.data
+    for name in ('lat', 'long'):
+        feed[name] = doc.getElementsByTagName('geo:%s' % name)[0].firstChild.data
+    feed['ttl'] = doc.getElementsByTagName('ttl')[0].firstChild.data
+    doc.unlink()
+    return feed
+
+def parse_benchmark(options, filenames):
+    if not filenames:
+        filenames = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'testdata', 'yahoo_caxx0531.xml')]
+    print '%d parses of each feed' % options.parse
+    print '%-30s %10s %10s %10s' % ('', 'bytes', 'stream us', 'minidom us')
+    for filename in filenames:
+        fp = open(filename, 'rb')
+        data = fp.read()
+        fp.close()
+        results = []
+        for parse in (weatherbot.parse_yahoo_feed, parse_yahoo_minidom):
+            start = time.time()
+            for i in xrange(options.parse):
+                feed = parse(StringIO(data))
+            results.append((time.time() - start) / options.parse)
+        print '%-30s %10d %10.1f %10.1f' % (os.path.basename(filename), len(data),
+                                            results[0] * 1e6, results[1] * 1e6)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog [options] [feed...]')
+    parser.add_option('--nodes', type='int', default=100,
+                      help='number of weather nodes [%default]')
+    parser.add_option('--subscribers', type='int', default=5000,
+                      help='number of simulated subscribers [%default]')
+    parser.add_option('--probes', type='int', default=1000,
+                      help='number of presence probes [%default]')
+    parser.add_option('--messages', type='int', default=2000,
+                      help='number of forecast requests [%default]')
+    parser.add_option('--cycles', type='int', default=5,
+                      help='number of feed update cycles [%default]')
+    parser.add_option('--workers', type='int', default=4,
+                      help='number of refresh worker threads [%default]')
+    parser.add_option('--shards', type='int', default=0,
+                      help='number of shard processes (0 for none) [%default]')
+    parser.add_option('--send-rate', type='int', default=0,
+                      help='outgoing bytes per second (0 for no limit) [%default]')
+    parser.add_option('--timeout', type='float', default=120,
+                      help='seconds to wait for each phase [%default]')
+    parser.add_option('--roster-memory', type='int', default=0, metavar='N',
+                      help='measure roster memory for N subscriptions instead')
+    parser.add_option('--nodes-per-user', type='int', default=4,
+                      help='nodes each user subscribes to, for --roster-memory [%default]')
+    parser.add_option('--roster-save', type='int', default=0, metavar='N',
+                      help='time roster saves for N subscriptions instead')
+    parser.add_option('--parse', type='int', default=0, metavar='N',
+                      help='time N parses of the given feeds instead')
+    (options, args) = parser.parse_args()
+    if options.roster_memory:
+        roster_memory(options)
+    elif options.roster_save:
+        roster_save(options)
+    elif options.parse:
+        parse_benchmark(options, args)
+    else:
+        LoadTest(options).run()
@@ -8,41 +8,355 @@
 
 import xmpp
 import os
+import time
+import select
+import threading
+import Queue
 import jabberbot
 import subprocess
+from array import array
 from ConfigParser import RawConfigParser
 
+class ProcSampler:
+    """Reads the system statistics from /proc.
+
+    The files are kept open, and re-read from the start for each sample.
+    """
+    meminfo_keys = ('MemTotal', 'MemFree', 'SwapTotal', 'SwapFree')
+
+    def __init__(self):
+        self.uptime_fd = os.open('/proc/uptime', os.O_RDONLY)
+        self.meminfo_fd = os.open('/proc/meminfo', os.O_RDONLY)
+
+    def read(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 16384)
+
+    def uptime(self):
+        """Returns the uptime, in seconds."""
+        return float(self.read(self.uptime_fd).split(None, 1)[0])
+
+    def meminfo(self):
+        """Returns the memory and swap totals and free amounts, in kB."""
+        data = self.read(self.meminfo_fd)
+        meminfo = {}
+        for key in self.meminfo_keys:
+            start = data.find('%s:' % key)
+            if start == -1:
+                meminfo[key] = 0
+                continue
+            start += len(key) + 1
+            meminfo[key] = int(data[start:data.index('\n', start)].split()[0])
+        return meminfo
+
+class RingBuffer:
+    """The latest "size" values of a series, in a fixed-size array."""
+    def __init__(self, size):
+        self.values = array('f', [0.0]) * size
+        self.size = size
+        self.count = 0
+        self.pos = 0
+
+    def append(self, value):
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def latest(self):
+        """Returns the values, oldest first, as an array."""
+        if self.count < self.size:
+            return self.values[:self.count]
+        return self.values[self.pos:] + self.values[:self.pos]
+
+class History:
+    """History of the system statistics, at several resolutions.
+
+    For each resolution, the samples taken during each period are averaged,
+    and the averages are kept in ring buffers, so the memory used is fixed.
+    Periods in which no samples were taken are skipped.
+    """
+    series = ('load', 'memory', 'swap')
+    # name, length of a period in seconds, and number of periods kept
+    resolutions = (('minute', 60, 1440),
+                   ('hour', 3600, 720),
+                   ('day', 86400, 365))
+
+    def __init__(self):
+        self.buffers = {}
+        # resolution -> [current period, number of samples, sums]
+        self.current = {}
+        for (name, period, size) in self.resolutions:
+            for series in self.series:
+                self.buffers[(name, series)] = RingBuffer(size)
+            self.current[name] = [None, 0, [0.0] * len(self.series)]
+
+    def add(self, when, values):
+        """Record a sample, with a value for each series."""
+        for (name, period, size) in self.resolutions:
+            current = self.current[name]
+            start = int(when // period)
+            if current[0] != start:
+                if current[1]:
+                    for (series, total) in zip(self.series, current[2]):
+                        self.buffers[(name, series)].append(total / current[1])
+                current[:] = [start, 0, [0.0] * len(self.series)]
+            current[1] += 1
+            for (i, value) in enumerate(values):
+                current[2][i] += value
+
+    def get(self, resolution, series):
+        """Returns the averages of a series at a resolution, oldest first,
+        including the current, incomplete period."""
+        values = self.buffers[(resolution, series)].latest()
+        current = self.current[resolution]
+        if current[1]:
+            values.append(current[2][self.series.index(series)] / current[1])
+        return values
+
+def percentile(values, p):
+    """Returns the p-th percentile of a sorted sequence."""
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+sparks = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+def sparkline(values, width=60):
+    """Returns a line of block characters showing the values, averaged
+    down to at most "width" characters."""
+    if len(values) > width:
+        step = len(values) / float(width)
+        values = [sum(values[int(i * step):int((i + 1) * step)])
+                  / (int((i + 1) * step) - int(i * step))
+                  for i in xrange(width)]
+    low = min(values)
+    scale = (max(values) - low) or 1
+    top = len(sparks) - 1
+    return u''.join([sparks[int(round((x - low) / scale * top))] for x in values])
+
+class CommandExecutor:
+    """Runs commands in a pool of worker threads.
+
+    The output of each command is sent back in chunks as it is produced,
+    through the "output" queue, as (message, text) pairs, where "message" is
+    the message that asked for the command.  Commands that run for too long,
+    or produce too much output, are killed.
+    """
+    # how long to wait for more output before sending a partial chunk
+    flush_delay = 0.5
+
+    def __init__(self, workers=2, pending=10, timeout=60, chunk_size=4000,
+                 max_output=262144):
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.max_output = max_output
+        self.jobs = Queue.Queue(pending)
+        self.output = Queue.Queue()
+        for i in xrange(workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+
+    def submit(self, mess, args):
+        """Queue a command to run.  Returns False if too many commands are
+        already waiting.
+        """
+        try:
+            self.jobs.put_nowait((mess, args))
+        except Queue.Full:
+            return False
+        return True
+
+    def work(self):
+        while True:
+            (mess, args) = self.jobs.get()
+            try:
+                self.run(mess, args)
+            except Exception, e:
+                self.output.put((mess, str(e)))
+
+    def send(self, mess, text):
+        self.output.put((mess, text.decode('utf-8', 'replace')))
+
+    def run(self, mess, args):
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, close_fds=True)
+        fd = proc.stdout.fileno()
+        deadline = time.time() + self.timeout
+        buffered = ''
+        total = 0
+        error = None
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    error = 'command timed out after %d seconds' % self.timeout
+                    break
+                (readable, writable, errors) = \
+                    select.select([fd], [], [], min(remaining, self.flush_delay))
+                if not readable:
+                    # no output for a while: send what we have so far
+                    if buffered:
+                        self.send(mess, buffered)
+                        buffered = ''
+                    continue
+                data = os.read(fd, 4096)
+                if not data:
+                    break
+                total += len(data)
+                if total > self.max_output:
+                    data = data[:len(data) - (total - self.max_output)]
+                    error = 'output truncated after %d bytes' % self.max_output
+                buffered += data
+                while len(buffered) >= self.chunk_size:
+                    # split at a line break if there is one
+                    split = buffered.rfind('\n', 0, self.chunk_size) + 1 \
+                            or self.chunk_size
+                    self.send(mess, buffered[:split])
+                    buffered = buffered[split:]
+                if error:
+                    break
+        finally:
+            if error and proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+        if buffered:
+            self.send(mess, buffered)
+        if error:
+            self.output.put((mess, error))
+
 class SystemBot(jabberbot.JabberBot):
+    formats = {'load': '%.2f', 'memory': '%.1f%%', 'swap': '%.1f%%'}
+
+    def parse_history_args(self, args):
+        """Returns the series and resolution named in the arguments of a
+        history command, or None and an error message."""
+        names = [x[0] for x in History.resolutions]
+        series = []
+        resolution = 'minute'
+        for arg in args.split():
+            if arg in History.series:
+                series.append(arg)
+            elif arg in names:
+                resolution = arg
+            else:
+                return (None, 'unknown argument "%s": expected %s'
+                        % (arg, ', '.join(History.series + tuple(names))))
+        return (series or History.series, resolution)
+
+    def bot_history(self, mess, args):
+        """Shows recent load, memory and swap usage.  Usage: history
+        [load|memory|swap] [minute|hour|day]"""
+        (series, resolution) = self.parse_history_args(args)
+        if series is None:
+            return resolution
+        lines = []
+        for name in series:
+            values = self.history.get(resolution, name)
+            if not values:
+                return 'no samples yet'
+            format = self.formats[name]
+            lines.append(u'%s: %s (min %s, max %s, last %s; %d %ss)'
+                         % (name, sparkline(values), format % min(values),
+                            format % max(values), format % values[-1],
+                            len(values), resolution))
+        return u'\n'.join(lines)
+
+    def bot_stats(self, mess, args):
+        """Shows percentiles of the load, memory and swap usage.  Usage:
+        stats [load|memory|swap] [minute|hour|day]"""
+        (series, resolution) = self.parse_history_args(args)
+        if series is None:
+            return resolution
+        lines = []
+        for name in series:
+            values = sorted(self.history.get(resolution, name))
+            if not values:
+                return 'no samples yet'
+            format = self.formats[name]
+            lines.append('%s over %d %ss: min %s, p50 %s, p90 %s, p99 %s, max %s, mean %s'
+                         % (name, len(values), resolution,
+                            format % values[0], format % percentile(values, 50),
+                            format % percentile(values, 90),
+                            format % percentile(values, 99),
+                            format % values[-1],
+                            format % (sum(values) / len(values))))
+        return '\n'.join(lines)
+
     def bot_exec(self, mess, args):
-    	"""Executes the given command"""
-	if args.strip() == '':
-		return 'needs arguments'
-	else:
-		try:
-			return subprocess.Popen(args.split(), stdout=subprocess.PIPE).communicate()[0]
-		except Exception, e:
-			return e
+        """Executes the given command"""
+        if args.strip() == '':
+            return 'needs arguments'
+        if not self.executor.submit(mess, args.split()):
+            return 'too many commands running, try again later'
 
     def bot_who(self, mess, args):
         """Display who's currently logged in."""
-        who_pipe = os.popen('/usr/bin/who', 'r')
-        who = who_pipe.read().strip()
-        who_pipe.close()
+        if not self.executor.submit(mess, ['/usr/bin/who']):
+            return 'too many commands running, try again later'
 
-        return who
+    def __init__(self, username, password, interval=60,
+                 load_threshold=0.5, memory_threshold=5, **executor_options):
+        jabberbot.JabberBot.__init__(self, username, password)
+        self.executor = CommandExecutor(**executor_options)
+        self.sampler = ProcSampler()
+        self.history = History()
+        # how often to sample, in seconds
+        self.interval = interval
+        # how much the load average, or the memory or swap usage (in
+        # percentage points), must change before a new presence is sent
+        self.load_threshold = load_threshold
+        self.memory_threshold = memory_threshold
+        self.next_sample = 0
+        self.published = None
+
+    def send_output(self):
+        """Send the output of the commands that have run.
+        """
+        while True:
+            try:
+                (mess, text) = self.executor.output.get_nowait()
+            except Queue.Empty:
+                return
+            self.conn.send(xmpp.Message(mess.getFrom(), text, typ=mess.getType()))
 
     def idle_proc(self):
+        self.send_output()
+
+        now = time.time()
+        if now < self.next_sample:
+            return
+        self.next_sample = now + self.interval
+
+        loadavg = os.getloadavg()
+        meminfo = self.sampler.meminfo()
+        memused = 100 - (100*meminfo['MemFree']/meminfo['MemTotal'])
+        if meminfo['SwapTotal']:
+            swapused = 100 - (100*meminfo['SwapFree']/meminfo['SwapTotal'])
+        else:
+            swapused = 0
+        # the history keeps the exact percentages
+        memory = 100.0 * (meminfo['MemTotal'] - meminfo['MemFree']) / meminfo['MemTotal']
+        swap = 0.0
+        if meminfo['SwapTotal']:
+            swap = 100.0 * (meminfo['SwapTotal'] - meminfo['SwapFree']) / meminfo['SwapTotal']
+        self.history.add(now, (loadavg[0], memory, swap))
+
+        # only send a new presence if something has changed significantly
+        if self.published is not None:
+            (lastload, lastmem, lastswap) = self.published
+            if abs(loadavg[0] - lastload) < self.load_threshold \
+               and abs(memused - lastmem) < self.memory_threshold \
+               and abs(swapused - lastswap) < self.memory_threshold:
+                return
+        self.published = (loadavg[0], memused, swapused)
+
         status = []
 
-        load = 'load average: %s %s %s' % os.getloadavg()
+        load = 'load average: %s %s %s' % loadavg
         status.append(load)
 
         # calculate the uptime
-        uptime_file = open('/proc/uptime')
-        uptime = uptime_file.readline().split()[0]
-        uptime_file.close()
-
-        uptime = float(uptime)
+        uptime = self.sampler.uptime()
         (uptime,secs) = (int(uptime / 60), uptime % 60)
         (uptime,mins) = divmod(uptime,60)
         (days,hours) = divmod(uptime,24)
@@ -51,41 +365,43 @@ class SystemBot(jabberbot.JabberBot):
         status.append(uptime)
 
         # calculate memory and swap usage
-        meminfo_file = open('/proc/meminfo')
-        meminfo = {}
-        for x in meminfo_file:
-            try:
-                (key,value,junk) = x.split(None, 2)
-                key = key[:-1] # strip off the trailing ':'
-                meminfo[key] = int(value)
-            except:
-                pass
-        meminfo_file.close()
-
         memusage = 'Memory used: %d of %d kB (%d%%) - %d kB free' \
                    % (meminfo['MemTotal']-meminfo['MemFree'],
                       meminfo['MemTotal'],
-                      100 - (100*meminfo['MemFree']/meminfo['MemTotal']),
+                      memused,
                       meminfo['MemFree'])
         status.append(memusage)
         if meminfo['SwapTotal']:
             swapusage = 'Swap used: %d of %d kB (%d%%) - %d kB free' \
                       % (meminfo['SwapTotal']-meminfo['SwapFree'],
                          meminfo['SwapTotal'],
-                         100 - (100*meminfo['SwapFree']/meminfo['SwapTotal']),
+                         swapused,
                          meminfo['SwapFree'])
             status.append(swapusage)
 
         status = '\n'.join(status)
         # TODO: set "show" based on load? e.g. > 1 means "away"
-        if not hasattr(self, 'laststatus') or self.laststatus != status:
-            self.conn.send(xmpp.Presence(status=status))
-            self.laststatus = status
+        self.conn.send(xmpp.Presence(status=status))
         return
 
 config = RawConfigParser()
 config.read(['/etc/systembot.cfg','systembot.cfg'])
 
+options = {}
+if config.has_option('systembot','interval'):
+    options['interval'] = config.getint('systembot','interval')
+if config.has_option('systembot','load_threshold'):
+    options['load_threshold'] = config.getfloat('systembot','load_threshold')
+if config.has_option('systembot','memory_threshold'):
+    options['memory_threshold'] = config.getint('systembot','memory_threshold')
+if config.has_option('systembot','exec_workers'):
+    options['workers'] = config.getint('systembot','exec_workers')
+if config.has_option('systembot','exec_timeout'):
+    options['timeout'] = config.getint('systembot','exec_timeout')
+if config.has_option('systembot','exec_max_output'):
+    options['max_output'] = config.getint('systembot','exec_max_output')
+
 bot = SystemBot(config.get('systembot','username'),
-                config.get('systembot','password'))
+                config.get('systembot','password'),
+                **options)
 bot.serve_forever()
@@ -0,0 +1,412 @@
+#!/usr/bin/python
+"""Tests for the weather bot
+
+The feeds are served from the fixtures in the "testdata" directory by a
+local HTTP server.
+
+Usage: python test_weatherbot.py
+"""
+
+__license__ = """This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details."""
+
+import os
+import threading
+import tempfile
+import shutil
+import hashlib
+import unittest
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+import xmpp
+import weatherbot
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+def fixture(name):
+    fp = open(os.path.join(TESTDATA, name), 'rb')
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server serving the fixtures, with keep-alive connections.
+
+    "/<name>" serves the fixture of that name (or the contents set in
+    "feeds"), with an ETag and Last-Modified header, and answers matching
+    conditional requests with "304 Not Modified".  "/moved/<name>" redirects
+    to "/<name>".  The headers of every request are kept in "requests".
+    """
+    daemon_threads = True
+    last_modified = 'Mon, 17 Mar 2008 13:00:00 GMT'
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FixtureHandler)
+        self.lock = threading.Lock()
+        self.feeds = {}
+        self.requests = []
+        self.connections = 0
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server_port, name)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.lock.acquire()
+        self.server.connections += 1
+        self.server.lock.release()
+
+    def do_GET(self):
+        self.server.lock.acquire()
+        self.server.requests.append((self.path, self.headers))
+        self.server.lock.release()
+        if self.path.startswith('/moved/'):
+            self.send_response(301)
+            self.send_header('Location', self.path[len('/moved'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        name = self.path[1:]
+        data = self.server.feeds.get(name)
+        if data is None:
+            data = fixture(name)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.server.last_modified)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class FeedTestCase(unittest.TestCase):
+    """Runs each test with a fresh spool directory, feed server, connection
+    pool and feed registry."""
+    def setUp(self):
+        self.spooldir = tempfile.mkdtemp()
+        weatherbot.spooldir = self.spooldir
+        weatherbot.httppool = weatherbot.HTTPPool()
+        weatherbot.feeds = weatherbot.FeedRegistry()
+        # fetch again on every refresh
+        weatherbot.feeds.max_age = 0
+        self.server = FixtureServer()
+        self.server.start()
+
+    def tearDown(self):
+        for conns in weatherbot.httppool.idle.itervalues():
+            for conn in conns:
+                conn.close()
+        self.server.stop()
+        shutil.rmtree(self.spooldir)
+
+class ParserTest(unittest.TestCase):
+    def test_weathernetwork(self):
+        record = weatherbot.parse_weathernetwork_feed(StringIO(fixture('twn_caon0696.xml')))
+        self.assertEqual(record['location'], 'Waterloo, ON')
+        self.assertEqual(record['link'],
+                         'http://www.theweathernetwork.com/weather/caon0696?ref=rss')
+        self.assertEqual(record['conditions'],
+                         ['Light Rain', u'9 \xb0C', 'Humidity 93%',
+                          'Wind E 9km/h', 'Pressure 101.2 kPa'])
+        self.assertEqual(record['forecast'],
+                         [u'Tonight: Rain ending overnight. Low 4 \xb0C. POP 80%',
+                          u'Tuesday: A mix of sun and cloud. High 12\xb0C.'])
+        self.assertEqual(record['ttl'], 30)
+
+    def test_weathernetwork_empty(self):
+        record = weatherbot.parse_weathernetwork_feed(StringIO('<rss><channel/></rss>'))
+        self.assertEqual(record['conditions'], ['[no data]'])
+        self.assertEqual(record['forecast'], [])
+        self.assertEqual(record['ttl'], None)
+
+    def test_html_text(self):
+        self.assertEqual(weatherbot.html_text('<b>Sunny</b>,&nbsp;5&#176;C &amp; &bogus;'),
+                         u'Sunny , 5\xb0C & &bogus;')
+
+    def test_render_utf8(self):
+        record = weatherbot.parse_weathernetwork_feed(StringIO(fixture('twn_caon0696.xml')))
+        (status, forecast, info) = weatherbot.WeatherRenderer().render(record, 'http://x/')
+        for text in (status, forecast, info):
+            self.assert_(isinstance(text, str))
+        self.assert_('9 \xc2\xb0C' in status)
+        # non-ASCII text must survive being put in a stanza and serialized
+        presence = xmpp.protocol.Presence(status=status)
+        self.assert_('9 \xc2\xb0C' in weatherbot.StanzaTemplate(presence).render('a@b'))
+
+class YahooWeatherTest(FeedTestCase):
+    def test_output(self):
+        """The output is the same, byte for byte, as that of the original
+        minidom-based YahooWeather, which the .status, .forecast and .info
+        fixtures were recorded from."""
+        bot = weatherbot.YahooWeather({'location': 'CAXX0531', 'units': 'c'})
+        feed_url = bot.url
+        bot.url = self.server.url('yahoo_caxx0531.xml')
+        bot.refresh()
+        self.assertEqual(bot.presence.getStatus(), fixture('yahoo_caxx0531.status'))
+        self.assertEqual(bot.forecast, fixture('yahoo_caxx0531.forecast'))
+        self.assertEqual(bot.info, fixture('yahoo_caxx0531.info').replace(feed_url, bot.url))
+        self.assertEqual(bot.coordinates, (43.47, -80.53))
+        self.assertEqual(bot.ttl, 60)
+
+class FeedCacheTest(FeedTestCase):
+    def test_not_modified(self):
+        url = self.server.url('twn_caon0696.xml')
+        data = fixture('twn_caon0696.xml')
+        self.assertEqual(weatherbot.feedcache.fetch(url), (data, True))
+        self.assertEqual(self.server.requests[0][1].getheader('If-None-Match'), None)
+        # answered with a 304, from the cached copy
+        self.assertEqual(weatherbot.feedcache.fetch(url), (data, False))
+        headers = self.server.requests[1][1]
+        self.assertEqual(headers.getheader('If-None-Match'),
+                         '"%s"' % hashlib.md5(data).hexdigest())
+        self.assertEqual(headers.getheader('If-Modified-Since'), FixtureServer.last_modified)
+
+    def test_modified(self):
+        url = self.server.url('twn_caon0696.xml')
+        weatherbot.feedcache.fetch(url)
+        data = fixture('twn_caon0696.xml').replace('Light Rain', 'Heavy Rain')
+        self.server.feeds['twn_caon0696.xml'] = data
+        self.assertEqual(weatherbot.feedcache.fetch(url), (data, True))
+        self.assertEqual(weatherbot.feedcache.read(url)['data'], data)
+
+    def test_same_contents(self):
+        # a server that ignores the conditional request, but sends the same
+        # contents
+        url = self.server.url('twn_caon0696.xml')
+        (data, modified) = weatherbot.feedcache.fetch(url)
+        entry = weatherbot.feedcache.read(url)
+        entry['etag'] = '"stale"'
+        weatherbot.feedcache.save(url, entry)
+        self.assertEqual(weatherbot.feedcache.fetch(url), (data, False))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_damaged(self):
+        url = self.server.url('twn_caon0696.xml')
+        weatherbot.feedcache.fetch(url)
+        fp = open(weatherbot.feedcache.filename(url), 'wb')
+        fp.write('damaged')
+        fp.close()
+        self.assertEqual(weatherbot.feedcache.fetch(url),
+                         (fixture('twn_caon0696.xml'), True))
+        self.assertEqual(self.server.requests[1][1].getheader('If-None-Match'), None)
+
+class FeedFetcherTest(FeedTestCase):
+    def fetcher(self, name):
+        bot = weatherbot.WeatherNetwork({'location': 'caon0696'})
+        bot.url = self.server.url(name)
+        return bot
+
+    def test_not_modified(self):
+        bot = self.fetcher('twn_caon0696.xml')
+        self.assertNotEqual(bot.refresh(), False)
+        record = bot.record
+        # the second fetch is conditional, and gets a 304
+        self.assertEqual(bot.refresh(), False)
+        self.assertEqual(len(self.server.requests), 2)
+        headers = self.server.requests[1][1]
+        self.assert_(headers.getheader('If-None-Match'))
+        self.assertEqual(headers.getheader('If-Modified-Since'), FixtureServer.last_modified)
+        self.assert_(bot.record is record)
+
+    def test_changed(self):
+        bot = self.fetcher('twn_caon0696.xml')
+        bot.refresh()
+        self.server.feeds['twn_caon0696.xml'] = \
+            fixture('twn_caon0696.xml').replace('Light Rain', 'Heavy Rain')
+        self.assertNotEqual(bot.refresh(), False)
+        self.assert_(bot.presence.getStatus().startswith('Heavy Rain\n'))
+
+    def test_shared(self):
+        bots = [self.fetcher('twn_caon0696.xml') for i in xrange(3)]
+        weatherbot.feeds.max_age = 120
+        for bot in bots:
+            bot.refresh()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assert_(bots[1].record is bots[0].record)
+        self.assert_(bots[2].forecast is bots[0].forecast)
+
+class HTTPPoolTest(FeedTestCase):
+    def test_redirect_keepalive(self):
+        pool = weatherbot.httppool
+        for i in xrange(3):
+            (status, headers, body) = pool.get(self.server.url('moved/twn_caon0696.xml'))
+            self.assertEqual(status, 200)
+            self.assertEqual(body, fixture('twn_caon0696.xml'))
+        # three redirects and three fetches, all on one connection
+        self.assertEqual([path for (path, headers) in self.server.requests],
+                         ['/moved/twn_caon0696.xml', '/twn_caon0696.xml'] * 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnect(self):
+        pool = weatherbot.httppool
+        pool.get(self.server.url('twn_caon0696.xml'))
+        # the server closes the idle connection
+        for conn in pool.idle.values()[0]:
+            conn.sock.shutdown(2)
+        (status, headers, body) = pool.get(self.server.url('twn_caon0696.xml'))
+        self.assertEqual(status, 200)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_too_many_redirects(self):
+        pool = weatherbot.httppool
+        self.assertRaises(IOError, pool.get, self.server.url('moved/moved/' * 3 + 'x'))
+
+class RosterTest(unittest.TestCase):
+    def roster(self):
+        roster = weatherbot.Roster()
+        for i in xrange(10):
+            roster.add('n', 'u%d@x' % i)
+        return roster
+
+    def test_unsubscribe_during_broadcast(self):
+        roster = self.roster()
+        users = roster.subscribers('n')
+        sent = [users.next() for i in xrange(5)]
+        # before and after the last user sent
+        roster.discard('n', 'u1@x')
+        roster.discard('n', 'u7@x')
+        sent.extend(users)
+        self.assertEqual(sent, ['u%d@x' % i for i in (0, 1, 2, 3, 4, 5, 6, 8, 9)])
+
+    def test_subscribe_during_broadcast(self):
+        roster = self.roster()
+        users = roster.subscribers('n')
+        sent = [users.next() for i in xrange(5)]
+        # reuses the ID freed by u2, before the last user sent
+        roster.discard('n', 'u2@x')
+        roster.add('n', 'new@x')
+        sent.extend(users)
+        self.assertEqual(sent, ['u%d@x' % i for i in xrange(10)])
+
+    def test_outbox(self):
+        class Connection:
+            Namespace = 'jabber:component:accept'
+            def __init__(self):
+                self.sent = []
+            def send(self, data):
+                self.sent.append(data)
+        roster = self.roster()
+        conn = Connection()
+        presence = xmpp.protocol.Presence(frm='n@w/Y')
+        presence.setNamespace(conn.Namespace)
+        # rate limited to five stanzas at a time
+        template = weatherbot.StanzaTemplate(presence)
+        size = len(template.render('u0@x'))
+        outbox = weatherbot.Outbox(conn, rate=1, burst=5 * size)
+        outbox.broadcast(('n', 'Y'), template, roster.subscribers('n'))
+        self.assertEqual(outbox.flush(), 5)
+        # subscribes after the last user sent, and unsubscribes before it
+        roster.add('n', 'u10@x')
+        roster.discard('n', 'u1@x')
+        self.assertEqual(outbox.flush(False), 6)
+        self.assertEqual(''.join(conn.sent),
+                         ''.join([template.render('u%d@x' % i)
+                                  for i in (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10)]))
+        self.assertEqual(outbox.broadcasts, {})
+
+class MetricsTest(unittest.TestCase):
+    def test_remote(self):
+        local = weatherbot.Metrics()
+        remote = weatherbot.Metrics()
+        for m in (local, remote):
+            m.enabled = True
+            m.incr('refreshes', feed='a')
+            m.observe('seconds', 0.002, feed='a')
+            m.set('depth', 3)
+        remote.incr('refreshes', feed='b')
+        remote.error('b', 'failed')
+        local.add_remote('shard0', remote.snapshot())
+        # later metrics from the shard are not seen until the next snapshot
+        remote.incr('refreshes', feed='a')
+        lines = local.report().splitlines()
+        for line in ('refreshes{feed="a"} 2', 'refreshes{feed="b"} 1',
+                     'seconds_count{feed="a"} 2', 'seconds_bucket{feed="a",le="0.005"} 2',
+                     'depth 3', 'depth{source="shard0"} 3'):
+            self.assert_(line in lines, line)
+        self.assert_([x for x in lines if x.startswith('# error b at ') and x.endswith(': failed')])
+        local.add_remote('shard0', remote.snapshot())
+        self.assert_('refreshes{feed="a"} 3' in local.render().splitlines())
+
+class BotOptionsTest(unittest.TestCase):
+    def setUp(self):
+        weatherbot.bots = {}
+        weatherbot.bot_options = {}
+
+    def options(self, *sections):
+        """Returns bot options for (node, resource, location, priority)
+        tuples."""
+        return dict([((node, resource), {'class': 'WeatherNetwork',
+                                         'location': location,
+                                         'priority': str(priority)})
+                     for (node, resource, location, priority) in sections])
+
+    def state(self):
+        return dict([((node, resource), (bot.url, priority))
+                     for (node, x) in weatherbot.bots.iteritems()
+                     for (resource, (bot, priority)) in x.iteritems()])
+
+    def test_changes(self):
+        weatherbot.apply_bot_options(self.options(('a', 'Y', 'a', 1), ('b', 'Y', 'b', 1),
+                                                  ('c', 'Y', 'c', 1), ('c', 'Z', 'c', 1)))
+        a = weatherbot.bots['a']['Y'][0]
+        c = weatherbot.bots['c']['Y'][0]
+        options = self.options(('a', 'Y', 'a', 10), ('c', 'Y', 'cc', 1),
+                               ('c', 'Z', 'c', 1), ('d', 'Y', 'd', 1))
+        (added, removed, reprioritized) = weatherbot.apply_bot_options(options)
+        self.assertEqual(sorted(added), [('c', 'Y'), ('d', 'Y')])
+        self.assertEqual(sorted(removed), [('b', 'Y'), ('c', 'Y')])
+        self.assertEqual(reprioritized, [('a', 'Y')])
+        self.assertEqual(sorted(weatherbot.bots), ['a', 'c', 'd'])
+        # reprioritized bots keep their data, replaced ones do not
+        self.assert_(weatherbot.bots['a']['Y'] == (a, 10))
+        self.assert_(weatherbot.bots['c']['Y'][0] is not c)
+        self.assert_(weatherbot.bots['c']['Y'][0].url.endswith('/cc'))
+        self.assert_(weatherbot.bot_options is options)
+
+    def test_failed(self):
+        options = self.options(('a', 'Y', 'a', 1), ('b', 'Y', 'b', 1))
+        weatherbot.apply_bot_options(options)
+        state = self.state()
+        bad_class = self.options(('a', 'Y', 'a', 1), ('c', 'Y', 'c', 1))
+        bad_class[('c', 'Y')]['class'] = 'NoSuchWeather'
+        bad_priority = self.options(('a', 'Y', 'a', 1))
+        bad_priority[('a', 'Y')]['priority'] = 'ten'
+        for bad in (bad_class, bad_priority):
+            self.assertRaises((KeyError, ValueError), weatherbot.apply_bot_options, bad)
+            self.assertEqual(self.state(), state)
+            self.assert_(weatherbot.bot_options is options)
+        # and a later reload still works
+        weatherbot.apply_bot_options(self.options(('a', 'Y', 'a', 2)))
+        self.assertEqual(self.state().keys(), [('a', 'Y')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,6 @@ http://www.uhoreg.ca/programming/jabberbots
 
 TODO:
 - catch signals
-- The Weather Network
 - better exception handling
 - DISCO
 - weather.uwaterloo.ca
@@ -35,16 +34,44 @@ __author__ = "Hubert Chathi <hubert@uhoreg.ca>"
 
 import time
 import urllib
+import urllib2
+import httplib
+import urlparse
 import xmpp
-from xml.dom import minidom
+try:
+    import xml.etree.cElementTree as ElementTree
+except:
+    import xml.etree.ElementTree as ElementTree
 from os import path
 try:
     import cPickle as pickle
 except:
     import pickle
 import errno
+import os
+import fcntl
+import select
+import socket
+import hashlib
+import sqlite3
+from cStringIO import StringIO
+from xml.sax.saxutils import quoteattr
 import threading
+import Queue
+import heapq
+import bisect
+from collections import deque
+from array import array
+import sys
+import zlib
+import tempfile
+import multiprocessing
+import traceback
 import random
+import math
+import re
+import htmlentitydefs
+import signal
 from ConfigParser import RawConfigParser
 
 random.seed()
@@ -60,8 +87,15 @@ class WeatherFetcherExample:
 
     The class must have a "presence" variable.
 
+    The "refresh" method may return False to indicate that the data has not
+    changed since the last refresh, in which case the presence is not sent
+    out again.
+
     The class must also have a "refresh_test(self, time)" method or an
     "update_time" variable.
+
+    Fetchers that get their data from a feed can subclass FeedFetcher, and
+    only need to provide the feed's URL and a parser.
     """
     def refresh(self):
         pass
@@ -90,156 +124,1466 @@ class WeatherFetcherExample:
     update_time = 'the time of the next update'
 
 
-def random_periodic_update_time (offset=5, frequency=1, maxrand=5):
+def random_periodic_update_time (offset=5, frequency=1, maxrand=None, key=None):
     """Returns a random update time for periodic updates.
+
+    By default, the update time is spread over the whole period (after the
+    offset), so that many feeds do not all get refreshed at the same time.
+    If "key" is given, the same key always gets the same time within the
+    period, so that fetchers that share a feed get refreshed together.
     """
     now = time.time()
     base = 3600/frequency
-    return now + base - (now % base) + offset*60 + random.randint(0,maxrand*60)
+    if maxrand is None:
+        maxrand = base/60 - offset
+    if key is None:
+        rand = random.randint(0,maxrand*60)
+    else:
+        rand = random.Random(key).randint(0,maxrand*60)
+    return now + base - (now % base) + offset*60 + rand
 
 
-class YahooWeather:
-    """Get weather data from Yahoo! Weather <http://weather.yahoo.com>
+class Metrics:
+    """Counters, gauges and histograms describing what the bot is doing.
 
-    Detailed information on Yahoo!'s weather feeds can be found at:
-    http://developer.yahoo.com/weather/
+    Nothing is recorded unless "enabled" is set, so the instrumentation
+    costs next to nothing when it is turned off.  Metrics can be rendered
+    in the Prometheus text format.
+
+    Snapshots of the metrics of other processes (the shards) can be added
+    in: their counters and histograms are added to this process's, and
+    their gauges are labelled with their source.
     """
-    def __init__(self,opts):
-        self.url = 'http://weather.yahooapis.com/forecastrss?p=%s' % opts['location']
-        if opts.has_key('units'):
-            self.url += '&u=%s' % opts['units']
+    # default histogram buckets, in seconds
+    time_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
 
-    commands = ['forecast', 'info']
-    forecast_help = 'displays the current forecast'
-    info_help = 'displays information on this weather feed'
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [buckets, bucket counts, sum, count]
+        self.histograms = {}
+        # last error for each feed
+        self.errors = {}
+        # source -> latest snapshot from another process
+        self.remote = {}
+
+    def after_fork(self):
+        """Replace the lock, which may have been held by the parent's
+        threads, in a forked process."""
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.lock.release()
 
-    def refresh(self):
-        fp = urllib.urlopen(self.url)
-        doc = minidom.parse(fp)
-        fp.close()
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
 
-        units = doc.getElementsByTagName('yweather:units')[0]
-        temperature_units = units.getAttribute('temperature')
-        distance_units = units.getAttribute('distance')
-        pressure_units = units.getAttribute('pressure')
-        speed_units = units.getAttribute('speed')
+    def observe(self, name, value, buckets=None, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                buckets = buckets or self.time_buckets
+                histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0, 0]
+            i = bisect.bisect_left(histogram[0], value)
+            if i < len(histogram[1]):
+                histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+        finally:
+            self.lock.release()
+
+    def error(self, feed, message):
+        if not self.enabled:
+            return
+        self.errors[feed] = (time.time(), message)
 
+    def snapshot(self):
+        """Returns a copy of the metrics, for add_remote in another process.
+        """
+        self.lock.acquire()
         try:
-            conditions = doc.getElementsByTagName('yweather:condition')[0]
-            conditions_text = "%s, %s %s (%s)" % (conditions.getAttribute('text'), conditions.getAttribute('temp'), temperature_units, conditions.getAttribute('date'))
-        except:
-            conditions_text = '[no data]'
+            histograms = dict([(key, [buckets, list(counts), total, count])
+                               for (key, (buckets, counts, total, count))
+                               in self.histograms.iteritems()])
+            return (dict(self.counters), dict(self.gauges), histograms,
+                    dict(self.errors))
+        finally:
+            self.lock.release()
+
+    def add_remote(self, source, snapshot):
+        """Add in a snapshot from another process, replacing the previous
+        one from the same source.
+        """
+        self.lock.acquire()
+        self.remote[source] = snapshot
+        self.lock.release()
+
+    def collect(self):
+        """Returns the counters, gauges, histograms and errors of this
+        process and the remote snapshots together.  Must be called with the
+        lock held.
+        """
+        counters = dict(self.counters)
+        gauges = dict(self.gauges)
+        histograms = dict([(key, [buckets, list(counts), total, count])
+                           for (key, (buckets, counts, total, count))
+                           in self.histograms.iteritems()])
+        errors = dict(self.errors)
+        for (source, (r_counters, r_gauges, r_histograms, r_errors)) in self.remote.iteritems():
+            for (key, value) in r_counters.iteritems():
+                counters[key] = counters.get(key, 0) + value
+            for ((name, labels), value) in r_gauges.iteritems():
+                labels = tuple(sorted(labels + (('source', source),)))
+                gauges[(name, labels)] = value
+            for (key, (buckets, counts, total, count)) in r_histograms.iteritems():
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histograms[key] = [buckets, list(counts), total, count]
+                else:
+                    for (i, n) in enumerate(counts):
+                        histogram[1][i] += n
+                    histogram[2] += total
+                    histogram[3] += count
+            for (feed, error) in r_errors.iteritems():
+                if not errors.has_key(feed) or errors[feed][0] < error[0]:
+                    errors[feed] = error
+        return (counters, gauges, histograms, errors)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format.
+        """
+        def escape(value):
+            return unicode(value).replace('\\','\\\\') \
+                                 .replace('"','\\"').replace('\n','\\n')
+
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join(['%s="%s"' % (k, escape(v))
+                                      for (k,v) in labels])
+
+        lines = []
+        self.lock.acquire()
+        try:
+            (counters, gauges, histograms, errors) = self.collect()
+            for (kind, values) in (('counter', counters),
+                                   ('gauge', gauges)):
+                lastname = None
+                for ((name, labels), value) in sorted(values.items()):
+                    if name != lastname:
+                        lines.append('# TYPE %s %s' % (name, kind))
+                        lastname = name
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+            lastname = None
+            for ((name, labels), (buckets, counts, total, count)) in sorted(histograms.items()):
+                if name != lastname:
+                    lines.append('# TYPE %s histogram' % name)
+                    lastname = name
+                cumulative = 0
+                for (bucket, n) in zip(buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', bucket)]), cumulative))
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), total))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines)
+
+    def report(self):
+        """Returns the metrics, followed by the last error for each feed.
+        """
+        report = [self.render()]
+        self.lock.acquire()
+        try:
+            errors = self.collect()[3]
+        finally:
+            self.lock.release()
+        for (feed, (when, message)) in sorted(errors.items()):
+            report.append('# error %s at %s: %s' % (feed, time.ctime(when), message))
+        return '\n'.join(report)
+
+    def dump(self, filename):
+        """Write the metrics to a file, for collection by an external agent.
+        """
+        tmpname = '%s.tmp' % filename
+        fp = open(tmpname, 'w')
+        try:
+            fp.write(self.render().encode('utf-8'))
+            fp.write('\n')
+        finally:
+            fp.close()
+        os.rename(tmpname, filename)
+
+metrics = Metrics()
+
+
+class HTTPPool:
+    """Persistent HTTP connections to the feed servers, shared by all the
+    fetchers.
 
+    Connections are kept open after a request, up to "max_idle" per server,
+    and reused for the next request to the same server.  A request that
+    fails on a reused connection is retried once on a new connection, since
+    the server may have closed it in the meantime.
+    """
+    max_idle = 4
+    max_redirects = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (scheme, host) -> idle connections
+        self.idle = {}
+
+    def after_fork(self):
+        """Drop the parent's connections, which it may still be using, and
+        replace the lock, in a forked process."""
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def connect(self, key):
+        self.lock.acquire()
         try:
-            # FIXME: convert wind direction into some thing human-readable
-            wind = doc.getElementsByTagName('yweather:wind')[0]
-            wind_text = 'Wind chill: %s %s; Wind: %s %s, %s' % (wind.getAttribute('chill'), temperature_units, wind.getAttribute('speed'), speed_units, wind.getAttribute('direction'))
-        except:
-            wind_text = 'Wind: [no data]'
+            idle = self.idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+        finally:
+            self.lock.release()
+        (scheme, host) = key
+        if scheme == 'http':
+            return (httplib.HTTPConnection(host, timeout=fetch_timeout), False)
+        elif scheme == 'https':
+            return (httplib.HTTPSConnection(host, timeout=fetch_timeout), False)
+        raise IOError('unsupported URL scheme "%s"' % scheme)
+
+    def release(self, key, conn):
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def get(self, url, headers={}):
+        """GET the given URL, following redirects.
+
+        Returns a tuple (status, headers, body), where "headers" are the
+        response headers, as an httplib.HTTPMessage.
+        """
+        for i in xrange(self.max_redirects + 1):
+            (scheme, host, urlpath, query, fragment) = urlparse.urlsplit(url)
+            key = (scheme.lower(), host.lower())
+            urlpath = urlpath or '/'
+            if query:
+                urlpath = '%s?%s' % (urlpath, query)
+            (conn, reused) = self.connect(key)
+            while True:
+                try:
+                    conn.request('GET', urlpath, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if not reused:
+                        raise
+                    (conn, reused) = self.connect(key)
+                    continue
+                break
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(key, conn)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            return (response.status, response.msg, body)
+        raise IOError('too many redirects fetching %s' % url)
+
+httppool = HTTPPool()
+
+
+class FeedCache:
+    """On-disk cache of fetched feeds, stored in the spool directory.
+
+    Feeds are fetched through "httppool", with conditional requests using
+    the ETag and Last-Modified headers of the previously cached response.
+    """
+    def filename(self, url):
+        return path.join(spooldir, 'feeds', hashlib.md5(url).hexdigest())
 
+    def read(self, url):
         try:
-            atmosphere = doc.getElementsByTagName('yweather:atmosphere')[0]
-            atmosphere_text = 'Presure: %s %s %s\nHumidity: %s%%\nVisibility: %s %s\n' \
-                              % (atmosphere.getAttribute('pressure'), pressure_units, ['steady', 'rising', 'falling'][int(atmosphere.getAttribute('rising'))],
-                                 atmosphere.getAttribute('humidity'),
-                                 atmosphere.getAttribute('visibility'), distance_units)
-        except:
-            atmosphere_text = 'Pressure: [no data]\nHumidity: [no data]\nVisibility: [no data]'
+            fp = open(self.filename(url), 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            try:
+                return pickle.load(fp)
+            except (EOFError, pickle.UnpicklingError):
+                # damaged cache entry: fetch it again
+                return None
+        finally:
+            fp.close()
+
+    def save(self, url, entry):
+        filename = self.filename(url)
+        try:
+            os.makedirs(path.dirname(filename))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # several threads or processes may be saving the same feed
+        (fd, tmpname) = tempfile.mkstemp(dir=path.dirname(filename))
+        fp = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(entry, fp, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        os.rename(tmpname, filename)
+
+    def fetch(self, url):
+        """Fetch the given URL.
+
+        Returns a tuple (data, modified), where "data" is the body of the
+        feed, and "modified" is False if the feed is the same as the cached
+        copy (either because the server replied with "304 Not Modified", or
+        because the contents are identical).
+        """
+        cached = self.read(url)
+        headers = {}
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        (status, headers, data) = httppool.get(url, headers)
+        if status == 304 and cached:
+            return (cached['data'], False)
+        if status != 200:
+            raise urllib2.HTTPError(url, status, 'HTTP error %d' % status,
+                                    headers, None)
+
+        digest = hashlib.sha1(data).hexdigest()
+        modified = not cached or cached['digest'] != digest
+        self.save(url, {'data': data,
+                        'digest': digest,
+                        'etag': headers.getheader('ETag'),
+                        'last_modified': headers.getheader('Last-Modified')})
+        return (data, modified)
+
+feedcache = FeedCache()
+
+
+def normalize_url(url):
+    """Returns a normalized form of the URL, for comparing feed URLs.
+    """
+    (scheme, netloc, urlpath, query, fragment) = urlparse.urlsplit(url)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(query, True)))
+    return urlparse.urlunsplit((scheme.lower(), netloc.lower(), urlpath or '/',
+                                query, ''))
+
+class FeedRegistry:
+    """Shares fetched and parsed feeds between fetchers that use the same URL.
+
+    Each feed (by normalized URL) is fetched and parsed once, and the parsed
+    feed is handed to every fetcher that asks for it within "max_age"
+    seconds.  If a feed is already being fetched, other fetchers wait for
+    that fetch instead of starting their own.
+    """
+    max_age = 120
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # normalized url -> [lock, parsed feed, expiry time]
+        self.feeds = {}
+
+    def after_fork(self):
+        """Replace the locks, which may have been held by the parent's
+        threads, in a forked process."""
+        self.lock = threading.Lock()
+        for entry in self.feeds.itervalues():
+            entry[0] = threading.Lock()
+
+    def fetch(self, url, parse):
+        """Returns the parsed feed at the given URL.
+
+        "parse" is called with a file-like object to parse the feed.  The
+        result is shared, so it must not be modified by the caller.  The same
+        object is returned for as long as the feed does not change.
+        """
+        key = normalize_url(url)
+        self.lock.acquire()
+        try:
+            entry = self.feeds.get(key)
+            if entry is None:
+                entry = self.feeds[key] = [threading.Lock(), None, 0]
+        finally:
+            self.lock.release()
+
+        entry[0].acquire()
+        try:
+            if entry[1] is None or time.time() >= entry[2]:
+                start = time.time()
+                (data, modified) = feedcache.fetch(url)
+                fetched = time.time()
+                metrics.observe('weatherbot_refresh_stage_seconds', fetched - start,
+                                feed=key, stage='fetch')
+                if modified or entry[1] is None:
+                    entry[1] = parse(StringIO(data))
+                    metrics.observe('weatherbot_refresh_stage_seconds',
+                                    time.time() - fetched, feed=key, stage='parse')
+                entry[2] = time.time() + self.max_age
+            return entry[1]
+        finally:
+            entry[0].release()
+
+feeds = FeedRegistry()
+
+
+YWEATHER_NS = '{http://xml.weather.yahoo.com/ns/rss/1.0}'
+GEO_NS = '{http://www.w3.org/2003/01/geo/wgs84_pos#}'
+
+def parse_yahoo_feed(fp):
+    """Parse a Yahoo! Weather RSS feed from a file-like object.
+
+    The feed is parsed incrementally in a single pass, and elements are
+    discarded as soon as they have been read.  Returns a dictionary with the
+    "units", "condition", "wind", "atmosphere" and "location" attributes (as
+    dictionaries), the list of "forecast" attributes, and the "link", "lat",
+    "long" and "ttl" text (any of which may be missing).
+    """
+    feed = {'units': {}, 'forecast': []}
+    in_item = False
+    for (event, elem) in ElementTree.iterparse(fp, events=('start','end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'item':
+                in_item = True
+            continue
+        if tag.startswith(YWEATHER_NS):
+            name = tag[len(YWEATHER_NS):]
+            if name == 'forecast':
+                feed['forecast'].append(dict(elem.attrib))
+            else:
+                feed[name] = dict(elem.attrib)
+        elif tag.startswith(GEO_NS):
+            feed[tag[len(GEO_NS):]] = elem.text
+        elif tag == 'link':
+            if in_item:
+                feed['link'] = elem.text
+        elif tag == 'ttl':
+            feed['ttl'] = elem.text
+        elif tag == 'item':
+            in_item = False
+        elem.clear()
+    return feed
+
+
+def yahoo_record(feed):
+    """Returns the weather record (see WeatherRenderer) for a feed parsed by
+    parse_yahoo_feed.
+    """
+    units = feed['units']
+    temperature_units = units.get('temperature','')
+    distance_units = units.get('distance','')
+    pressure_units = units.get('pressure','')
+    speed_units = units.get('speed','')
+
+    try:
+        conditions = feed['condition']
+        conditions_text = "%s, %s %s (%s)" % (conditions['text'], conditions['temp'], temperature_units, conditions['date'])
+    except:
+        conditions_text = '[no data]'
+
+    try:
+        # FIXME: convert wind direction into some thing human-readable
+        wind = feed['wind']
+        wind_text = 'Wind chill: %s %s; Wind: %s %s, %s' % (wind['chill'], temperature_units, wind['speed'], speed_units, wind['direction'])
+    except:
+        wind_text = 'Wind: [no data]'
+
+    try:
+        atmosphere = feed['atmosphere']
+        atmosphere_text = 'Presure: %s %s %s\nHumidity: %s%%\nVisibility: %s %s\n' \
+                          % (atmosphere['pressure'], pressure_units, ['steady', 'rising', 'falling'][int(atmosphere['rising'])],
+                             atmosphere['humidity'],
+                             atmosphere['visibility'], distance_units)
+    except:
+        atmosphere_text = 'Pressure: [no data]\nHumidity: [no data]\nVisibility: [no data]'
+
+    forecast = []
+    for x in feed['forecast']:
+        forecast.append('%s, %s: %s, high %s %s, low %s %s' % (
+            x.get('day',''), x.get('date',''),
+            x.get('text',''),
+            x.get('high',''), temperature_units,
+            x.get('low',''), temperature_units))
+
+    location = feed['location']
+    if location.get('region',''):
+        location = ', '.join([location.get('city',''),
+                              location.get('region',''),
+                              location.get('country','')])
+    else:
+        location = ', '.join([location.get('city',''),
+                              location.get('country','')])
+
+    try:
+        ttl = int(feed['ttl'])
+    except:
+        ttl = None
+
+    return {'source': 'Yahoo! Weather',
+            'source_url': 'http://weather.yahoo.com',
+            'location': location,
+            'link': feed['link'],
+            'conditions': [conditions_text, wind_text] + atmosphere_text.split('\n'),
+            'forecast': forecast,
+            'lat': feed.get('lat'),
+            'long': feed.get('long'),
+            'ttl': ttl}
+
+def replace_entity(match):
+    name = match.group(1)
+    try:
+        if name.startswith('#x'):
+            return unichr(int(name[2:], 16))
+        elif name.startswith('#'):
+            return unichr(int(name[1:]))
+        return unichr(htmlentitydefs.name2codepoint[name])
+    except (KeyError, ValueError):
+        return match.group(0)
+
+def html_text(html):
+    """Returns the text of an HTML fragment, without tags or entities, and
+    with the whitespace collapsed.
+    """
+    text = re.sub(r'<[^>]*>', ' ', html or '')
+    text = re.sub(r'&(#x[0-9a-fA-F]+|#[0-9]+|\w+);', replace_entity, text)
+    return ' '.join(text.split())
+
+def parse_weathernetwork_feed(fp):
+    """Parse a Weather Network RSS feed from a file-like object, and return
+    its weather record (see WeatherRenderer).
+
+    The first item holds the current conditions, as a comma separated list
+    in its description, and the other items hold the forecast for the coming
+    periods.  Like parse_yahoo_feed, the feed is parsed in a single pass.
+    """
+    title = link = ttl = None
+    items = []
+    item = None
+    for (event, elem) in ElementTree.iterparse(fp, events=('start','end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'item':
+                item = {}
+            continue
+        if item is not None:
+            if tag == 'item':
+                items.append(item)
+                item = None
+            elif tag in ('title', 'link', 'description'):
+                item[tag] = elem.text
+        elif tag == 'title' and title is None:
+            title = elem.text
+        elif tag == 'link' and link is None:
+            link = elem.text
+        elif tag == 'ttl':
+            ttl = elem.text
+        elem.clear()
+
+    location = re.sub(r'(?i)\s*[-:|]?\s*the weather network\s*[-:|]?\s*', '',
+                      html_text(title))
+    if items:
+        current = items.pop(0)
+        conditions = [x.strip() for x in html_text(current.get('description')).split(',')
+                      if x.strip()] or ['[no data]']
+        link = current.get('link') or link
+    else:
+        conditions = ['[no data]']
+    forecast = ['%s: %s' % (html_text(x.get('title')), html_text(x.get('description')))
+                for x in items]
+    try:
+        ttl = int(ttl)
+    except (TypeError, ValueError):
+        ttl = None
+    return {'source': 'The Weather Network',
+            'source_url': 'http://www.theweathernetwork.com',
+            'location': location,
+            'link': link,
+            'conditions': conditions,
+            'forecast': forecast,
+            'ttl': ttl}
+
+
+def utf8(text):
+    """Returns text as a UTF-8 encoded string."""
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+class WeatherRenderer:
+    """Turns weather records into the text that the fetchers serve.
+
+    A weather record is a dictionary produced by a fetcher's parser, with
+    the "source" (name) and "source_url" of the weather service, the name of
+    the "location", the "link" to the full forecast, lists of "conditions"
+    and "forecast" lines, and optionally the "lat" and "long" of the
+    location (as text) and the feed's "ttl" (in minutes).
+
+    Renderings are memoized per feed URL, and reused for as long as the
+    FeedRegistry returns the same record.  The text is UTF-8 encoded, which
+    xmpppy accepts for non-ASCII text whatever its version.
+    """
+    def __init__(self):
+        # feed url -> (record, (status, forecast, info))
+        self.cache = {}
 
-        status = """%s
-%s
-%s
-Yahoo! Weather: <http://weather.yahoo.com>""" % (conditions_text, wind_text, atmosphere_text)
+    def render(self, record, url):
+        """Returns the (status, forecast, info) text for a record from the
+        feed at the given URL.
+        """
+        cached = self.cache.get(url)
+        if cached is not None and cached[0] is record:
+            return cached[1]
+        start = time.time()
+        source = record['source']
+        status = '\n'.join(record['conditions'] +
+                           ['%s: <%s>' % (source, record['source_url'])])
+        forecast = '\n'.join(record['forecast'] +
+                             ['Full forecast from %s: %s' % (source, record['link'])])
+        info = ['Weather for %s, from %s <%s>.' % (record['location'], source, record['source_url']),
+                'full forecast: <%s>' % record['link'],
+                'feed url: <%s>' % url]
+        if record.get('lat') and record.get('long'):
+            info.append('%s is at: lat %s, long %s' % (record['location'], record['lat'], record['long']))
+        rendering = tuple([utf8(x) for x in (status, forecast, '\n'.join(info))])
+        self.cache[url] = (record, rendering)
+        metrics.observe('weatherbot_refresh_stage_seconds', time.time() - start,
+                        feed=normalize_url(url), stage='render')
+        return rendering
+
+renderer = WeatherRenderer()
+
+
+class FeedFetcher:
+    """Base class for fetchers that get their data from a feed.
+
+    A refresh goes through three stages, each shared between fetchers: the
+    feed is fetched through "feeds", which downloads and parses each feed
+    once for all the fetchers that use it; it is parsed by the subclass's
+    "parse(fp)" method into a weather record; and the record is turned into
+    the presence, forecast and info text by "renderer".  If the record has
+    not changed, the refresh stops there.
+
+    Subclasses must set "url", and implement "parse" so that it reads the
+    feed in a single pass and returns a weather record (see WeatherRenderer).
+    """
+    commands = ['forecast', 'info']
+    forecast_help = 'displays the current forecast'
+    info_help = 'displays information on this weather feed'
 
+    # placeholders until the first successful refresh
+    presence = xmpp.protocol.Presence(status='[no data]')
+    forecast = '[no data]'
+    info = '[no data]'
+    record = None
+    ttl = None
+    # (latitude, longitude) of the location, in degrees
+    coordinates = None
+
+    def refresh(self):
+        record = feeds.fetch(self.url, self.parse)
+        if record is self.record:
+            self.update_time = self.next_update_time()
+            return False
+        (status, self.forecast, self.info) = renderer.render(record, self.url)
         self.presence = xmpp.protocol.Presence(status=status)
+        try:
+            self.coordinates = (float(record['lat']), float(record['long']))
+        except (KeyError, TypeError, ValueError):
+            self.coordinates = None
+        self.ttl = record.get('ttl')
+        self.record = record
+        self.update_time = self.next_update_time()
+
+    def next_update_time(self):
+        """Returns the time of the next update, no sooner than the feed's ttl.
+        """
+        update_time = random_periodic_update_time(key=normalize_url(self.url))
+        if self.ttl:
+            update_time = max(update_time, time.time() + 60*self.ttl)
+        return update_time
 
-        forecast = []
-        for x in doc.getElementsByTagName('yweather:forecast'):
-            forecast.append('%s, %s: %s, high %s %s, low %s %s' % (
-                x.getAttribute('day'), x.getAttribute('date'),
-                x.getAttribute('text'),
-                x.getAttribute('high'), temperature_units,
-                x.getAttribute('low'), temperature_units))
-        forecast.append('Full forecast from Yahoo! Weather: %s' % doc.getElementsByTagName('item')[0].getElementsByTagName('link')[0].firstChild.data)
-        self.forecast = '\n'.join(forecast)
-
-        location = doc.getElementsByTagName('yweather:location')[0]
-        if location.getAttribute('region'):
-            location = ', '.join([location.getAttribute('city'),
-                                  location.getAttribute('region'),
-                                  location.getAttribute('country')])
-        else:
-            location = ', '.join([location.getAttribute('city'),
-                                  location.getAttribute('country')])
 
-        self.info = """Weather for %s, from Yahoo! Weather <http://weather.yahoo.com>.
-full forecast: <%s>
-feed url: <%s>
-%s is at: lat %s, long %s""" % (location,
-                                doc.getElementsByTagName('item')[0].getElementsByTagName('link')[0].firstChild.data,
-                                self.url,
-                                location, doc.getElementsByTagName('geo:lat')[0].firstChild.data, doc.getElementsByTagName('geo:long')[0].firstChild.data)
+class YahooWeather(FeedFetcher):
+    """Get weather data from Yahoo! Weather <http://weather.yahoo.com>
+
+    Detailed information on Yahoo!'s weather feeds can be found at:
+    http://developer.yahoo.com/weather/
+    """
+    def __init__(self,opts):
+        self.url = 'http://weather.yahooapis.com/forecastrss?p=%s' % opts['location']
+        if opts.has_key('units'):
+            self.url += '&u=%s' % opts['units']
 
-        #self.update_time = 60*int(doc.getElementsByTagName('ttl')[0].firstChild.data) + time.time()
-        self.update_time = random_periodic_update_time()
+    def parse(self, fp):
+        return yahoo_record(parse_yahoo_feed(fp))
 
 
-class WeatherNetwork:
+class WeatherNetwork(FeedFetcher):
     """Fetch weather from The Weather Network <http://www.theweathernetwork.com>
     """
     def __init__(self,opts):
         self.url = 'http://rss.theweathernetwork.com/weather/%s' % opts['location']
 
-    commands = ['forecast', 'info']
-    forecast_help = 'displays the current forecast'
-    info_help = 'displays information on this weather feed'
+    def parse(self, fp):
+        return parse_weathernetwork_feed(fp)
+
+
+class Roster:
+    """Compact in-memory roster.
 
-    # FIXME:
+    Every bare JID is interned once, as a UTF-8 string with an integer ID,
+    and each node's subscribers are a sorted array of IDs.  A user subscribed
+    to several nodes costs one string, plus four bytes per node.  The IDs of
+    JIDs that have no subscriptions left are reused.
 
+    Subscribers are returned as UTF-8 strings, ready for StanzaTemplate.
+    "roster" is an optional dictionary mapping nodes to sets of JIDs.
+    """
+    def __init__(self, roster=None):
+        # JID -> ID, and ID -> JID (None for free IDs)
+        self.ids = {}
+        self.jids = []
+        # number of nodes each ID is subscribed to
+        self.refs = array('i')
+        self.free = []
+        # node -> sorted array of IDs
+        self.nodes = {}
+        if roster:
+            for (node,users) in roster.iteritems():
+                ids = [self.intern(user) for user in set(users)]
+                ids.sort()
+                self.nodes[node] = array('i', ids)
+
+    def __getstate__(self):
+        return (self.jids, self.refs.tostring(), self.free,
+                dict([(node,ids.tostring()) for (node,ids) in self.nodes.iteritems()]))
+
+    def __setstate__(self, state):
+        (self.jids, refs, self.free, nodes) = state
+        self.refs = array('i')
+        self.refs.fromstring(refs)
+        self.ids = dict([(user,id) for (id,user) in enumerate(self.jids)
+                         if user is not None])
+        self.nodes = {}
+        for (node,x) in nodes.iteritems():
+            ids = self.nodes[node] = array('i')
+            ids.fromstring(x)
+
+    def __len__(self):
+        """Returns the total number of subscriptions."""
+        return sum([len(x) for x in self.nodes.itervalues()])
+
+    def intern(self, user):
+        """Returns the ID of the JID, allocating one if needed, and counts a
+        new reference to it."""
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        id = self.ids.get(user)
+        if id is None:
+            if self.free:
+                id = self.free.pop()
+                self.jids[id] = user
+            else:
+                id = len(self.jids)
+                self.jids.append(user)
+                self.refs.append(0)
+            self.ids[user] = id
+        self.refs[id] += 1
+        return id
+
+    def release(self, id):
+        """Drops a reference to an ID, freeing it if it was the last one."""
+        self.refs[id] -= 1
+        if not self.refs[id]:
+            del self.ids[self.jids[id]]
+            self.jids[id] = None
+            self.free.append(id)
+
+    def has(self, node, user):
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        id = self.ids.get(user)
+        if id is None:
+            return False
+        ids = self.nodes.get(node,())
+        i = bisect.bisect_left(ids, id)
+        return i < len(ids) and ids[i] == id
+
+    def subscribers(self, node):
+        # broadcasts read this lazily, while users subscribe and unsubscribe,
+        # so carry on after the last ID returned rather than from an index
+        # into the array, which insertions and deletions shift
+        (i, last) = (0, None)
+        while True:
+            ids = self.nodes.get(node,())
+            if last is not None and not (0 < i <= len(ids) and ids[i-1] == last):
+                i = bisect.bisect_right(ids, last)
+            if i >= len(ids):
+                return
+            last = ids[i]
+            i += 1
+            yield self.jids[last]
+
+    def add(self, node, user):
+        """Subscribes the user to the node.  Returns False if it already
+        was."""
+        id = self.intern(user)
+        ids = self.nodes.get(node)
+        if ids is None:
+            ids = self.nodes[node] = array('i')
+        i = bisect.bisect_left(ids, id)
+        if i < len(ids) and ids[i] == id:
+            self.release(id)
+            return False
+        ids.insert(i, id)
+        return True
+
+    def discard(self, node, user):
+        """Unsubscribes the user from the node.  Returns False if it was not
+        subscribed."""
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        id = self.ids.get(user)
+        ids = self.nodes.get(node)
+        if id is None or ids is None:
+            return False
+        i = bisect.bisect_left(ids, id)
+        if i == len(ids) or ids[i] != id:
+            return False
+        del ids[i]
+        if not ids:
+            del self.nodes[node]
+        self.release(id)
+        return True
 
 class RosterStorage:
     """Class used to abstract out the roster storage.
-    This class just uses pickle.
+
+    The roster is stored as a pickled snapshot, plus a journal of the
+    subscriptions and unsubscriptions made since the snapshot was written.
+    Once the journal gets long, it is compacted into a new snapshot.  The
+    whole roster is kept in memory, as a Roster.
+
+    Roster storage classes must implement "open", "has", "subscribers",
+    "add", "discard", "sync" and "close" methods, and may implement "read"
+    and "save" to load or replace the whole roster as a Roster.
     """
+    # minimum number of journal records before compacting
+    compact_threshold = 10000
+    # fsync the journal after this many records, or this many seconds
+    sync_records = 100
+    sync_interval = 5
+
+    def __init__(self):
+        self.roster = Roster()
+        self.journal = None
+        self.records = 0
+        self.compact_at = self.compact_threshold
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def snapshot_filename(self):
+        return path.join(spooldir,'roster')
+
+    def open(self):
+        self.read()
+
+    def journal_filename(self):
+        return path.join(spooldir,'roster.journal')
+
     def read(self):
-        filename = path.join(spooldir,'roster')
+        roster = Roster()
         try:
-            fp = open(filename)
+            fp = open(self.snapshot_filename(),'rb')
             if fp:
-                rv = pickle.load(fp)
+                roster = pickle.load(fp)
                 fp.close()
-                return rv
         except IOError, e:
             if e.errno != errno.ENOENT:
                 raise
-        return {}
+        if isinstance(roster, dict):
+            # snapshot from before rosters were interned
+            roster = Roster(roster)
+
+        # replay the journal
+        records = 0
+        torn = False
+        try:
+            fp = open(self.journal_filename(),'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            for line in fp:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError
+                    (op,node,user) = line.decode('utf-8')[:-1].split(u'\t')
+                except ValueError:
+                    # incomplete record, from a crash while writing
+                    torn = True
+                    continue
+                if op == u'+':
+                    roster.add(str(node),user)
+                elif op == u'-':
+                    roster.discard(str(node),user)
+                records += 1
+            fp.close()
+
+        self.roster = roster
+        self.records = records
+        self.compact_at = max(self.compact_threshold, self.size())
+        if torn:
+            # start over with a clean journal
+            self.save(roster)
+        return roster
 
     def save(self,roster):
-        filename = path.join(spooldir,'roster')
-        fp = open(filename,'w')
-        if fp:
-            pickle.dump(roster,fp)
+        """Write a snapshot of the whole roster, and start a new journal.
+        """
+        self.roster = roster
+        filename = self.snapshot_filename()
+        tmpname = '%s.tmp' % filename
+        fp = open(tmpname,'wb')
+        try:
+            pickle.dump(roster,fp,pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
             fp.close()
+        os.rename(tmpname,filename)
+
+        if self.journal:
+            self.journal.close()
+        self.journal = open(self.journal_filename(),'wb')
+        self.records = 0
+        self.compact_at = max(self.compact_threshold, self.size())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def size(self):
+        """Returns the total number of subscriptions.
+        """
+        return len(self.roster)
+
+    def has(self,node,user):
+        """Returns True if the user is subscribed to the node.
+        """
+        return self.roster.has(node,user)
+
+    def subscribers(self,node):
+        """Returns an iterator over the users subscribed to the node.
+        """
+        return self.roster.subscribers(node)
+
+    def add(self,node,user):
+        """Subscribe a user to a node.
+        """
+        if self.roster.add(node,user):
+            self.append(u'+',node,user)
+
+    def discard(self,node,user):
+        """Unsubscribe a user from a node.
+        """
+        if self.roster.discard(node,user):
+            self.append(u'-',node,user)
+
+    def append(self,op,node,user):
+        """Append a record to the journal, compacting it if needed.
+        """
+        if self.journal is None:
+            self.journal = open(self.journal_filename(),'ab')
+        self.journal.write((u'%s\t%s\t%s\n' % (op,node,user)).encode('utf-8'))
+        self.journal.flush()
+        self.records += 1
+        self.unsynced += 1
+        if self.records >= self.compact_at:
+            self.save(self.roster)
+        else:
+            self.sync(False)
+
+    def sync(self,force=True):
+        """Flush the journal to disk.
+        If "force" is False, it is only flushed if enough records or time
+        have accumulated.
+        """
+        if not self.unsynced:
+            return
+        if force or self.unsynced >= self.sync_records \
+           or time.time() - self.last_sync >= self.sync_interval:
+            os.fsync(self.journal.fileno())
+            self.unsynced = 0
+            self.last_sync = time.time()
+
+    def close(self):
+        if self.journal:
+            self.sync()
+            self.journal.close()
+            self.journal = None
+
+class SQLiteRosterStorage:
+    """Roster storage using an SQLite database in the spool directory.
+
+    Nothing is kept in memory: lookups and updates are single queries on the
+    (node, jid) index, and subscribers are read with a cursor.
+    """
+    # commit after this many changes, or this many seconds
+    sync_records = 100
+    sync_interval = 5
+    # subscribers read per query
+    page_size = 1000
+
+    def __init__(self):
+        self.db = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def open(self):
+        self.db = sqlite3.connect(path.join(spooldir,'roster.db'))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS roster (
+                               node TEXT NOT NULL,
+                               jid TEXT NOT NULL)""")
+        self.db.execute("""CREATE UNIQUE INDEX IF NOT EXISTS roster_node_jid
+                               ON roster (node, jid)""")
+        self.db.commit()
+
+    def read(self):
+        roster = {}
+        for (node,user) in self.db.execute('SELECT node, jid FROM roster'):
+            roster.setdefault(str(node),set()).add(user)
+        return Roster(roster)
+
+    def save(self,roster):
+        self.db.execute('DELETE FROM roster')
+        for node in roster.nodes.keys():
+            self.db.executemany('INSERT OR IGNORE INTO roster (node, jid) VALUES (?, ?)',
+                                ((node,user.decode('utf-8')) for user in roster.subscribers(node)))
+        self.db.commit()
+        self.unsynced = 0
+
+    def has(self,node,user):
+        return self.db.execute('SELECT 1 FROM roster WHERE node = ? AND jid = ?',
+                               (node,user)).fetchone() is not None
+
+    def subscribers(self,node):
+        # read a page at a time in index order, rather than keep a cursor
+        # open while a broadcast is sent, since a commit would reset it
+        last = u''
+        while True:
+            users = self.db.execute('SELECT jid FROM roster WHERE node = ? AND jid > ? '
+                                    'ORDER BY jid LIMIT ?',
+                                    (node,last,self.page_size)).fetchall()
+            for (user,) in users:
+                yield user
+            if len(users) < self.page_size:
+                break
+            last = users[-1][0]
+
+    def add(self,node,user):
+        self.db.execute('INSERT OR IGNORE INTO roster (node, jid) VALUES (?, ?)',
+                        (node,user))
+        self.unsynced += 1
+        self.sync(False)
+
+    def discard(self,node,user):
+        self.db.execute('DELETE FROM roster WHERE node = ? AND jid = ?',
+                        (node,user))
+        self.unsynced += 1
+        self.sync(False)
+
+    def sync(self,force=True):
+        """Commit pending changes.
+        If "force" is False, they are only committed if enough changes or
+        time have accumulated.
+        """
+        if not self.unsynced:
+            return
+        if force or self.unsynced >= self.sync_records \
+           or time.time() - self.last_sync >= self.sync_interval:
+            self.db.commit()
+            self.unsynced = 0
+            self.last_sync = time.time()
+
+    def close(self):
+        if self.db:
+            self.sync()
+            self.db.close()
+            self.db = None
+
+def serialize(stanza):
+    """Returns an xmpppy stanza as a UTF-8 encoded string.
+
+    Depending on its version, xmpppy serializes to unicode or to UTF-8, and
+    only one of unicode() and str() works on non-ASCII stanzas.
+    """
+    return utf8(stanza.__str__())
+
+class StanzaTemplate:
+    """A stanza that is serialized once, and then sent to many recipients.
+
+    The recipient is spliced into the serialized stanza, just after the
+    element name, so the stanza must not have a "to" attribute.  Stanzas are
+    rendered as UTF-8 encoded strings, ready to be written to the socket.
+    """
+    def __init__(self, stanza):
+        xml = serialize(stanza)
+        split = len(stanza.getName()) + 1
+        self.head = xml[:split]
+        self.tail = xml[split:]
+
+    def render(self, to):
+        if isinstance(to, unicode):
+            to = to.encode('utf-8')
+        return '%s to=%s%s' % (self.head, quoteattr(to), self.tail)
+
+class Outbox:
+    """Queue of outgoing stanzas, sent from the main loop.
+
+    Replies to users (command replies, subscription handshakes, and presence
+    sent in answer to a subscription or probe) go out before presence
+    broadcasts, so that a large broadcast does not hold up interactive
+    traffic.  Sending is limited by a token bucket of "rate" bytes per
+    second, up to "burst" bytes at once, to keep within the server's karma;
+    a rate of 0 means no limit.
+
+    At most "max_replies" replies are queued, and further ones are dropped.
+    Broadcasts are queued per bot: a new broadcast for a bot replaces any
+    pending one, so stale presence is not sent out.  The subscribers of a
+    broadcast are read from the roster as it is sent, rather than all at
+    once.
+    """
+    # stanzas are joined into writes of about this many bytes
+    batch_size = 65536
+    max_replies = 10000
+    # histogram buckets for the number of stanzas in a presence broadcast
+    fanout_buckets = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+    def __init__(self, conn, rate=0, burst=65536):
+        self.conn = conn
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_fill = time.time()
+        self.replies = deque()
+        # (node,resource) -> [template, user iterator, stanzas sent, start time]
+        self.broadcasts = {}
+        self.broadcast_order = deque()
+        # broadcast stanzas sent since the last flush
+        self.presence_sent = 0
+
+    def put(self, stanza):
+        """Queue a reply, either as an xmpppy stanza or already serialized.
+        """
+        if not isinstance(stanza, str):
+            stanza.setNamespace(self.conn.Namespace)
+            stanza = serialize(stanza)
+        if len(self.replies) >= self.max_replies:
+            metrics.incr('weatherbot_outbox_dropped_total')
+            return
+        self.replies.append(stanza)
+
+    def broadcast(self, key, template, users):
+        """Queue a StanzaTemplate to be sent to an iterable of users,
+        replacing any pending broadcast with the same key.
+        """
+        if self.broadcasts.has_key(key):
+            metrics.incr('weatherbot_outbox_coalesced_total')
+        else:
+            self.broadcast_order.append(key)
+        self.broadcasts[key] = [template, iter(users), 0, time.time()]
+
+    def pending(self):
+        return bool(self.replies or self.broadcast_order)
+
+    def delay(self):
+        """Returns how long until more can be sent, or None if there is
+        nothing to send.
+        """
+        if not self.pending():
+            return None
+        if self.rate and self.tokens <= 0:
+            return -self.tokens / float(self.rate)
+        return 0
+
+    def next_stanza(self):
+        """Returns the next stanza to send, or None."""
+        if self.replies:
+            return self.replies.popleft()
+        while self.broadcast_order:
+            key = self.broadcast_order[0]
+            broadcast = self.broadcasts[key]
+            (template, users, sent, start) = broadcast
+            try:
+                user = users.next()
+            except StopIteration:
+                pass
+            else:
+                broadcast[2] = sent + 1
+                self.presence_sent += 1
+                return template.render(user)
+            self.broadcast_order.popleft()
+            del self.broadcasts[key]
+            metrics.observe('weatherbot_fanout_seconds', time.time() - start)
+            metrics.observe('weatherbot_fanout_size', sent,
+                            buckets=self.fanout_buckets)
+        return None
+
+    def flush(self, limit=True):
+        """Send as much as the rate limit allows, or everything if "limit"
+        is False.  Returns the number of stanzas sent.
+        """
+        if self.rate:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_fill) * self.rate)
+            self.last_fill = now
+        batch = []
+        size = 0
+        count = 0
+        while not (limit and self.rate and self.tokens <= 0):
+            stanza = self.next_stanza()
+            if stanza is None:
+                break
+            count += 1
+            batch.append(stanza)
+            size += len(stanza)
+            self.tokens -= len(stanza)
+            if size >= self.batch_size:
+                self.conn.send(''.join(batch))
+                batch = []
+                size = 0
+        if batch:
+            self.conn.send(''.join(batch))
+        if self.presence_sent:
+            metrics.incr('weatherbot_presence_stanzas_total', self.presence_sent)
+            self.presence_sent = 0
+        # the number of subscribers left is not known, so pending broadcasts
+        # are counted instead
+        metrics.set('weatherbot_outbox_depth', len(self.replies), queue='reply')
+        metrics.set('weatherbot_outbox_depth', len(self.broadcasts), queue='presence')
+        return count
+
+class CommandTable:
+    """Command dispatch table for a weather fetcher class.
+
+    For each command, records whether it is handled by a "handle_xxx"
+    method, a "get_xxx" method or an "xxx" attribute, and builds the help
+    text, so that this is not worked out again for every message.
+    """
+    def __init__(self, cls):
+        self.commands = {}
+        help = []
+        for command in cls.commands:
+            if hasattr(cls,'handle_%s' % command):
+                self.commands[command] = ('handle', 'handle_%s' % command)
+            elif hasattr(cls,'get_%s' % command):
+                self.commands[command] = ('get', 'get_%s' % command)
+            else:
+                self.commands[command] = ('attr', command)
+            if hasattr(cls,'%s_help' % command):
+                help.append('%s - %s' % (command, getattr(cls,'%s_help' % command)))
+            else:
+                help.append(command)
+        self.help = '\n'.join(help)
+
+command_tables = {}
+
+def get_command_table(cls):
+    """Returns the command table for the given fetcher class.
+    """
+    try:
+        return command_tables[cls]
+    except KeyError:
+        table = command_tables[cls] = CommandTable(cls)
+        return table
+
+class SpatialIndex:
+    """k-d tree of the coordinates of the nodes, for nearest neighbour
+    searches.
+
+    Points are stored as unit vectors, so that straight-line distances,
+    which rank points in the same order as great circle distances, can be
+    used without special cases at the poles or the date line.  New points
+    are inserted into the tree as they come in, and removed ones are marked
+    as dead; the tree is rebuilt once there are as many dead or inserted
+    points as there were points in the last build.
+    """
+    # mean radius of the Earth, in km
+    radius = 6371.0
+    # minimum size of the tree before it gets rebuilt
+    min_rebuild = 16
+
+    def __init__(self):
+        # node -> tree entry:
+        # [vector, node, axis, left, right, alive, coordinates]
+        self.nodes = {}
+        self.root = None
+        self.dead = 0
+        self.inserted = 0
+        self.built = 0
+
+    def vector(self, lat, long):
+        (lat, long) = (math.radians(lat), math.radians(long))
+        return (math.cos(lat) * math.cos(long),
+                math.cos(lat) * math.sin(long),
+                math.sin(lat))
+
+    def update(self, node, coordinates):
+        """Set the coordinates of a node, or remove it if they are None."""
+        old = self.nodes.get(node)
+        if old is not None:
+            if coordinates == old[6]:
+                return
+            old[5] = False
+            self.dead += 1
+            del self.nodes[node]
+        if coordinates is not None:
+            entry = [self.vector(*coordinates), node, 0, None, None, True, coordinates]
+            self.nodes[node] = entry
+            self.insert(entry)
+        if self.dead + self.inserted > max(self.built, self.min_rebuild):
+            self.rebuild()
+
+    def insert(self, entry):
+        self.inserted += 1
+        if self.root is None:
+            self.root = entry
+            return
+        parent = self.root
+        while True:
+            axis = parent[2]
+            side = entry[0][axis] < parent[0][axis] and 3 or 4
+            if parent[side] is None:
+                entry[2] = (axis + 1) % 3
+                parent[side] = entry
+                return
+            parent = parent[side]
+
+    def build(self, entries, axis):
+        if not entries:
+            return None
+        entries.sort(key=lambda entry: entry[0][axis])
+        middle = len(entries) // 2
+        entry = entries[middle]
+        entry[2] = axis
+        entry[3] = self.build(entries[:middle], (axis + 1) % 3)
+        entry[4] = self.build(entries[middle + 1:], (axis + 1) % 3)
+        return entry
+
+    def rebuild(self):
+        """Rebuild a balanced tree from the live points."""
+        self.root = self.build(self.nodes.values(), 0)
+        self.dead = 0
+        self.inserted = 0
+        self.built = len(self.nodes)
+
+    def nearest(self, lat, long, k=5, exclude=None):
+        """Returns the k nodes nearest to the point, as a sorted list of
+        (distance in km, node) pairs."""
+        (qx, qy, qz) = query = self.vector(lat, long)
+        # max-heap of the best so far, as (-squared distance, node)
+        best = []
+        stack = [(self.root, 0.0)]
+        while stack:
+            (entry, bound) = stack.pop()
+            if entry is None or (len(best) == k and bound >= -best[0][0]):
+                continue
+            (vector, node, axis, left, right, alive) = entry[:6]
+            if alive and node != exclude:
+                d = (vector[0] - qx) ** 2 + (vector[1] - qy) ** 2 + (vector[2] - qz) ** 2
+                if len(best) < k:
+                    heapq.heappush(best, (-d, node))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, node))
+            diff = query[axis] - vector[axis]
+            if diff < 0:
+                stack.append((right, diff * diff))
+                stack.append((left, bound))
+            else:
+                stack.append((left, diff * diff))
+                stack.append((right, bound))
+        best.sort(reverse=True)
+        return [(2 * self.radius * math.asin(min(1, math.sqrt(-d) / 2)), node)
+                for (d, node) in best]
 
 class WeatherBot:
     """Main weather bot class
     This class handles the bot's connection to the Jabber server, and processes
     messages from the server.
     """
-    def __init__(self):
-        self.rosterstorage = rosterstorage = RosterStorage()
-        self.roster = roster = rosterstorage.read()
-        rosterchanged = False
-        for x in bots.iterkeys():
-            if not roster.has_key(x):
-                roster[x] = set()
-                rosterchanged = True
-        if rosterchanged:
-            rosterstorage.save(roster)
-
-        self.conn = conn = xmpp.client.Component(server, port)
+    # how long to wait for something to happen in the main loop
+    tick = 1
+    # maximum number of reads from the connection between sending updates
+    max_reads = 100
+    # number of nodes listed by the "near" command
+    near_count = 5
+    near_help = 'near [<node> | <latitude> <longitude>] - lists the nearest weather nodes'
+
+    def __init__(self, debug=None):
+        self.rosterstorage = globals()[roster_class]()
+        self.rosterstorage.open()
+
+        # serialized presence for each (node,resource)
+        self.presences = {}
+        # serialized replies to commands, for each (node,resource)
+        self.replies = {}
+        # locations of the nodes, for the "near" command
+        self.spatial = SpatialIndex()
+        self.index_bots()
+        self.next_metrics_dump = 0
+        self.state_changed = False
+        self.next_state_save = time.time() + state_interval
+        # set on SIGHUP or by the "reload" command
+        self.reload_requested = False
+        # the WeatherUpdater or ShardSupervisor to tell about new bots
+        self.updater = None
+
+        if debug is None:
+            self.conn = conn = xmpp.client.Component(server, port)
+        else:
+            self.conn = conn = xmpp.client.Component(server, port, debug=debug)
         conn.connect()
         conn.auth(jid,password)
+        # stanzas are already batched, so don't let Nagle delay them
+        conn.Connection._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.outbox = Outbox(conn, send_rate, send_burst)
 
         # register handlers
         conn.RegisterDisconnectHandler(conn.reconnectAndReauth)
@@ -248,148 +1592,820 @@ class WeatherBot:
         conn.RegisterHandler('presence',self.unsubscribe_callback,typ='unsubscribe')
         conn.RegisterHandler('presence',self.probe_callback,typ='probe')
 
+    def index_bots(self):
+        """Work out the default resource (the one with the highest priority)
+        for each node, and build the command tables for the fetcher classes.
+        """
+        self.default_resources = {}
+        for (node,x) in bots.iteritems():
+            priority = None
+            for (resource,(bot,pri)) in x.iteritems():
+                get_command_table(bot.__class__)
+                if priority is None or pri > priority:
+                    self.default_resources[node] = resource
+                    priority = pri
+
     def message_callback(self, conn, message):
         """Handle messages from users
         """
+        start = time.time()
+        try:
+            self.process_message(conn, message)
+        finally:
+            metrics.observe('weatherbot_message_seconds', time.time() - start)
+
+    def process_message(self, conn, message):
+        """Reply to a message from a user
+        """
         to_user = xmpp.protocol.JID(jid=message.getTo())
-        if not bots.has_key(to_user.getNode()):
+        node = to_user.getNode()
+        if not bots.has_key(node):
             # sent to unknown user: ignore
             return
         # find the bot to send the reply from
         resource = to_user.getResource()
         if not resource:
-            priority = -1
-            for (res,(bot,pri)) in bots[to_user.getNode()].iteritems():
-                if pri > priority:
-                    resource = res
-        else:
-            if not bots[to_user.getNode()].has_key(resource):
-                # sent to unknown resource: ignore
-                return
-        bot = bots[to_user.getNode()][resource][0]
+            resource = self.default_resources[node]
+        elif not bots[node].has_key(resource):
+            # sent to unknown resource: ignore
+            return
+        bot = bots[node][resource][0]
+        table = get_command_table(bot.__class__)
 
         # process the command
-        command = message.getBody().split(None,1)[0].strip()
-        if command == 'help':
-            commands = []
-            for command in bot.commands:
-                if hasattr(bot,'%s_help' % command):
-                    commands.append('%s - %s' % (command, getattr(bot,'%s_help' % command)))
-                else:
-                    commands.append(command)
-            replytxt = '\n'.join(commands)
-        elif command not in bot.commands:
+        body = message.getBody()
+        if not body or not body.strip():
+            return
+        command = body.split(None,1)[0].strip()
+        if command in ('help','near'):
+            kind = command
+        elif command in ('stats','reload') and \
+             xmpp.protocol.JID(message.getFrom()).getStripped() in admins:
+            kind = command
+        elif not table.commands.has_key(command):
+            kind = 'error'
+        else:
+            (kind,name) = table.commands[command]
+
+        # replies that only depend on the bot's data are serialized once,
+        # and reused until the bot is updated
+        cacheable = kind in ('help','attr') and not message.getThread()
+        if cacheable:
+            replies = self.replies.setdefault((node,resource),{})
+            key = (unicode(to_user),command,message.getType())
+            if replies.has_key(key):
+                self.outbox.put(replies[key].render(unicode(message.getFrom())))
+                raise xmpp.NodeProcessed()
+
+        if kind == 'help':
+            replytxt = '%s\n%s' % (table.help, self.near_help)
+        elif kind == 'near':
+            replytxt = self.near(node, body.split()[1:])
+        elif kind == 'stats':
+            replytxt = metrics.report()
+        elif kind == 'reload':
+            # done from the main loop, once this message has been handled
+            self.request_reload()
+            replytxt = 'reloading configuration'
+        elif kind == 'error':
             replytxt = 'error: unknown command "%s"' % command
-        elif hasattr(bot,'handle_%s' % command):
-            return getattr(bot, 'handle_%s' % command)(conn, message)
-        elif hasattr(bot,'get_%s' % command):
-            replytxt = getattr(bot, 'get_%s' % command)(message)
+        elif kind == 'handle':
+            return getattr(bot, name)(conn, message)
+        elif kind == 'get':
+            replytxt = getattr(bot, name)(message)
         else:
-            replytxt = getattr(bot, command)
-        reply = message.buildReply(replytxt)
-        reply.setType(message.getType())
-        conn.send(reply)
+            replytxt = getattr(bot, name)
+
+        if cacheable:
+            reply = xmpp.protocol.Message(frm=to_user,body=replytxt,
+                                          typ=message.getType())
+            reply.setNamespace(self.conn.Namespace)
+            template = replies[key] = StanzaTemplate(reply)
+            self.outbox.put(template.render(unicode(message.getFrom())))
+        else:
+            reply = message.buildReply(replytxt)
+            reply.setType(message.getType())
+            self.outbox.put(reply)
         raise xmpp.NodeProcessed()
 
     def subscribe_callback(self, conn, presence):
         """Handle subscription requests
         """
-        to_user = xmpp.protocol.JID(jid=presence.getTo())
-        from_user = xmpp.protocol.JID(jid=presence.getFrom())
+        # the dispatcher has already parsed the addresses into JIDs
+        to_user = presence.getTo()
+        from_user = presence.getFrom()
         if bots.has_key(to_user.getNode()):
             # valid user: subscribe
             # update the roster
-            self.roster[to_user.getNode()].add(from_user.getStripped())
-            self.rosterstorage.save(self.roster)
+            self.rosterstorage.add(to_user.getNode(),from_user.getStripped())
             # send subscribed stanza
             reply = xmpp.protocol.Presence(to=from_user.getStripped(),typ='subscribed',frm=to_user.getStripped())
-            conn.send(reply)
+            self.outbox.put(reply)
             # send initial presence
-            node = bots[to_user.getNode()]
-            for (resource,(bot,priority)) in node.iteritems():
-                reply = bot.presence
-                reply.setPriority(priority)
-                reply.setFrom("%s/%s" % (to_user.getStripped(),resource))
-                reply.setTo(from_user.getStripped())
-                conn.send(reply)
+            for resource in bots[to_user.getNode()].iterkeys():
+                self.send_presence(to_user.getNode(),resource,
+                                   [from_user.getStripped()])
         else:
             # unknown user: send unsubscribe as error
             reply = xmpp.protocol.Presence(to=from_user.getStripped(),typ='unsubscribed',frm=to_user.getStripped())
-            conn.send(reply)
+            self.outbox.put(reply)
         raise xmpp.NodeProcessed()
 
     def unsubscribe_callback(self, conn, presence):
         """Handle unsubscription requests
         """
-        to_user = xmpp.protocol.JID(jid=presence.getTo())
-        from_user = xmpp.protocol.JID(jid=presence.getFrom())
+        to_user = presence.getTo()
+        from_user = presence.getFrom()
         if bots.has_key(to_user.getNode()):
             # update the roster
-            self.roster[to_user.getNode()].discard(from_user.getStripped())
-            self.rosterstorage.save(self.roster)
+            self.rosterstorage.discard(to_user.getNode(),from_user.getStripped())
         raise xmpp.NodeProcessed()
 
     def probe_callback(self, conn, presence):
         """Handle presence probes
         """
-        to_user = xmpp.protocol.JID(jid=presence.getTo())
-        from_user = xmpp.protocol.JID(jid=presence.getFrom())
+        to_user = presence.getTo()
+        from_user = presence.getFrom()
         if bots.has_key(to_user.getNode()) and \
-           from_user.getStripped() in self.roster[to_user.getNode()]:
-            node = bots[to_user.getNode()]
-            for (resource,(bot,priority)) in node.iteritems():
-                reply = bot.presence
-                reply.setPriority(priority)
-                reply.setFrom('%s/%s' % (to_user.getStripped(),resource))
-                reply.setTo(from_user.getStripped())
-                conn.send(reply)
+           self.rosterstorage.has(to_user.getNode(),from_user.getStripped()):
+            for resource in bots[to_user.getNode()].iterkeys():
+                self.send_presence(to_user.getNode(),resource,
+                                   [from_user.getStripped()])
         raise xmpp.NodeProcessed()
 
+    def presence_template(self, node, resource):
+        """Returns the serialized presence of the given bot.
+        """
+        try:
+            return self.presences[(node,resource)]
+        except KeyError:
+            (bot,priority) = bots[node][resource]
+            # copy the bot's presence, since the updater may replace it
+            presence = xmpp.protocol.Presence(node=bot.presence)
+            if presence.getAttr('to'):
+                presence.delAttr('to')
+            presence.setPriority(priority)
+            presence.setFrom('%s@%s/%s' % (node,jid,resource))
+            presence.setNamespace(self.conn.Namespace)
+            template = self.presences[(node,resource)] = StanzaTemplate(presence)
+            return template
+
+    def send_presence(self, node, resource, users):
+        """Send the presence of the given bot to the given users, as a
+        reply.
+        """
+        template = self.presence_template(node,resource)
+        for user in users:
+            self.outbox.put(template.render(user))
+
+    def broadcast_updates(self):
+        """Queue the presence of all updated bots for their subscribers.
+        """
+        for (node,resource) in take_updated():
+            if not bots.has_key(node) or not bots[node].has_key(resource):
+                # removed by a reload
+                continue
+            self.state_changed = True
+            self.presences.pop((node,resource), None)
+            self.replies.pop((node,resource), None)
+            self.locate(node)
+            self.outbox.broadcast((node,resource),
+                                  self.presence_template(node,resource),
+                                  self.rosterstorage.subscribers(node))
+
+    def locate(self, node):
+        """Update the location of a node in the spatial index, from the
+        first of its bots that has coordinates.
+        """
+        coordinates = None
+        for (bot,priority) in bots.get(node,{}).itervalues():
+            coordinates = getattr(bot,'coordinates',None)
+            if coordinates is not None:
+                break
+        self.spatial.update(node,coordinates)
+
+    def near(self, node, args):
+        """Returns the reply to a "near" command sent to the given node.
+        """
+        if len(args) == 2:
+            try:
+                (lat, long) = (float(args[0]), float(args[1]))
+            except ValueError:
+                return 'error: invalid coordinates'
+            if not (-90 <= lat <= 90 and -180 <= long <= 180):
+                return 'error: invalid coordinates'
+            exclude = None
+        elif len(args) <= 1:
+            if args:
+                node = args[0].split('@',1)[0]
+            if not self.spatial.nodes.has_key(node):
+                return 'error: the location of "%s" is not known' % node
+            (lat, long) = self.spatial.nodes[node][6]
+            exclude = node
+        else:
+            return 'usage: %s' % self.near_help
+        found = self.spatial.nearest(lat, long, self.near_count, exclude)
+        if not found:
+            return 'no weather nodes found'
+        return '\n'.join(['%s@%s: %d km' % (x, jid, round(distance))
+                          for (distance, x) in found])
+
+    def serve(self):
+        """Process incoming stanzas and send out updates, until interrupted.
+
+        The main loop waits on both the component connection and the waker,
+        so updates are sent out as soon as the updater has them, rather than
+        after the next stanza or timeout.  If the outbox is being rate
+        limited, it also wakes up when more can be sent.
+        """
+        while True:
+            sock = self.conn.Connection._sock
+            timeout = self.outbox.delay()
+            if timeout is None or timeout > self.tick:
+                timeout = self.tick
+            try:
+                (readable, writable, errors) = select.select([sock, waker], [], [],
+                                                             timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                # interrupted by a signal, e.g. SIGHUP
+                (readable, writable, errors) = ([], [], [])
+            if waker in readable:
+                waker.clear()
+            if self.reload_requested:
+                self.reload()
+            if sock in readable:
+                # handle everything that has arrived, but do not starve the
+                # updates if stanzas keep coming in
+                for i in xrange(self.max_reads):
+                    self.conn.Process(0)
+                    if not self.conn.isConnected() or \
+                       not self.conn.Connection.pending_data(0):
+                        break
+            self.broadcast_updates()
+            self.outbox.flush()
+            self.rosterstorage.sync(False)
+            if self.state_changed and time.time() >= self.next_state_save:
+                statestore.save()
+                self.state_changed = False
+                self.next_state_save = time.time() + state_interval
+            if metrics_file and time.time() >= self.next_metrics_dump:
+                metrics.dump(metrics_file)
+                self.next_metrics_dump = time.time() + metrics_interval
+
+    def request_reload(self):
+        """Ask the main loop to reload the configuration.  Safe to call from
+        a signal handler.
+        """
+        self.reload_requested = True
+        waker.wake()
+
+    def reload(self):
+        """Re-read the bot sections of the configuration, and apply the
+        changes.
+
+        Only new bots are started, and only removed bots are stopped, with
+        unavailable presence sent to their subscribers.  The other bots keep
+        running with their current data; a change of priority is sent out as
+        a presence update.
+        """
+        self.reload_requested = False
+        try:
+            options = read_bots(read_config())
+            (added, removed, reprioritized) = apply_bot_options(options)
+        except:
+            error = traceback.format_exception_only(*sys.exc_info()[:2])[-1].strip()
+            metrics.error('reload', error)
+            self.tell_admins('reload failed, configuration unchanged: %s' % error)
+            return
+        for (node,resource) in removed:
+            self.presences.pop((node,resource), None)
+            self.replies.pop((node,resource), None)
+            self.locate(node)
+            if (node,resource) not in added:
+                self.send_unavailable_from(node,resource)
+        for (node,resource) in reprioritized:
+            self.presences.pop((node,resource), None)
+            mark_updated(node,resource)
+        self.index_bots()
+        if self.updater is not None:
+            self.updater.reconfigure(added, removed)
+        metrics.incr('weatherbot_reloads_total')
+
+    def tell_admins(self, text):
+        """Send a message to all the admins.
+        """
+        for admin in admins:
+            message = xmpp.protocol.Message(to=admin, frm=jid, body=text)
+            self.outbox.put(message)
+
+    def send_unavailable_from(self, node, resource):
+        """Queue unavailable presence for the given bot to its subscribers,
+        replacing any pending broadcast of its presence.
+        """
+        presence = xmpp.protocol.Presence(typ='unavailable',
+                                          frm='%s@%s/%s' % (node,jid,resource))
+        presence.setNamespace(self.conn.Namespace)
+        self.outbox.broadcast((node,resource), StanzaTemplate(presence),
+                              self.rosterstorage.subscribers(node))
+
+    def send_unavailable(self):
+        """Send unavailable presence for all bots to all users, right away.
+        """
+        for (node,x) in bots.iteritems():
+            for resource in x.iterkeys():
+                self.send_unavailable_from(node,resource)
+        self.outbox.flush(False)
+
+class Waker:
+    """A pipe that other threads write to, to wake up the main loop.
+    """
+    def __init__(self):
+        (self.rfd, self.wfd) = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.rfd
+
+    def wake(self):
+        try:
+            os.write(self.wfd, 'x')
+        except OSError, e:
+            # if the pipe is full, the main loop is already going to wake up
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+waker = Waker()
+
+def get_state(bot):
+    """Returns the data of a fetcher that the bot serves: its presence, the
+    values of its attribute commands, its update time and its coordinates,
+    as a picklable dictionary.
+    """
+    state = {'status': bot.presence.getStatus(),
+             'show': bot.presence.getShow()}
+    for (kind,name) in get_command_table(bot.__class__).commands.itervalues():
+        if kind == 'attr':
+            state[name] = getattr(bot,name)
+    if hasattr(bot,'update_time'):
+        state['update_time'] = bot.update_time
+    if getattr(bot,'coordinates',None) is not None:
+        state['coordinates'] = bot.coordinates
+    return state
+
+def set_state(bot, state):
+    """Set the data of a fetcher from a dictionary returned by get_state.
+    """
+    state = state.copy()
+    bot.presence = xmpp.protocol.Presence(status=state.pop('status'),
+                                          show=state.pop('show'))
+    for (name,value) in state.iteritems():
+        setattr(bot,name,value)
+
+class StateStore:
+    """Snapshot of the data of all the fetchers, kept in the spool directory.
+
+    On startup, the bots are restored from the snapshot, so that they can be
+    served right away instead of waiting for every feed to be downloaded.
+    Only fetchers that have an "update_time" are saved.
+    """
+    def filename(self):
+        return path.join(spooldir,'state')
+
+    def load(self):
+        """Restore the data of the bots from the snapshot, and mark them as
+        updated.  Returns the number of bots restored.
+        """
+        try:
+            fp = open(self.filename(),'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        try:
+            try:
+                states = pickle.load(fp)
+            except (EOFError, pickle.UnpicklingError):
+                return 0
+        finally:
+            fp.close()
+
+        restored = 0
+        for (node,x) in bots.iteritems():
+            for (resource,(bot,priority)) in x.iteritems():
+                state = states.get((node,resource))
+                # don't use the data if the bot's configuration has changed
+                if state and state['class'] == bot.__class__.__name__ \
+                   and state['url'] == getattr(bot,'url',None):
+                    set_state(bot,state['data'])
+                    mark_updated(node,resource)
+                    restored += 1
+        return restored
+
+    def save(self):
+        states = {}
+        for (node,x) in bots.iteritems():
+            for (resource,(bot,priority)) in x.iteritems():
+                if hasattr(bot,'update_time'):
+                    states[(node,resource)] = {'class': bot.__class__.__name__,
+                                               'url': getattr(bot,'url',None),
+                                               'data': get_state(bot)}
+        (fd, tmpname) = tempfile.mkstemp(dir=spooldir)
+        fp = os.fdopen(fd,'wb')
+        try:
+            pickle.dump(states,fp,pickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        os.rename(tmpname,self.filename())
+
+statestore = StateStore()
+
 bots_updated_lock = threading.Lock()
 bots_updated = set()
 
+def mark_updated(node, resource):
+    """Flag the given bot as having new data to send out, and wake up the
+    main loop to send it."""
+    bots_updated_lock.acquire()
+    bots_updated.add((node,resource))
+    bots_updated_lock.release()
+    waker.wake()
+
+def is_current(node, resource, bot):
+    """Returns whether the given bot is still configured, i.e. has not been
+    removed or replaced by a reload."""
+    # a single lookup, as a reload may change bots from another thread
+    x = bots.get(node,{}).get(resource)
+    return x is not None and x[0] is bot
+
+def take_updated():
+    """Returns the set of updated bots, and starts a new one.
+    """
+    global bots_updated
+    bots_updated_lock.acquire()
+    updated = bots_updated
+    bots_updated = set()
+    bots_updated_lock.release()
+    return updated
+
 class WeatherUpdater(threading.Thread):
     """Update weather data periodically
+
+    Refreshes are done by a pool of worker threads, so that a slow feed does
+    not hold up the other ones.  The next refresh for each bot is kept in a
+    heap ordered by time, which the updater thread waits on.  Jobs and heap
+    entries carry the bot they are for, so that bots removed or replaced by
+    a reload drop out when they are next due.
     """
-    def __init__(self):
-        # load all the bot data
+    # how long to wait before retrying a failed refresh
+    retry_delay = 300
+    # how often to check bots that use "refresh_test"
+    poll_delay = 20
+
+    def __init__(self, workers=4):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.active = True
+        self.schedule = []
+        self.schedule_cond = threading.Condition()
+        self.jobs = Queue.Queue()
+        for i in xrange(workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+
+        # bots restored from a snapshot are refreshed when their data is due
+        # for an update, and the others right away
         for (node,x) in bots.iteritems():
-            for (resource,y) in x.iteritems():
-                y[0].refresh()
-                bots_updated_lock.acquire()
-                bots_updated.add((node,resource))
-                bots_updated_lock.release()
+            for (resource,(bot,priority)) in x.iteritems():
+                if hasattr(bot,'update_time'):
+                    self.schedule.append((bot.update_time,node,resource,bot))
+                else:
+                    self.jobs.put((node,resource,bot))
+        heapq.heapify(self.schedule)
+
+    def schedule_refresh(self, when, node, resource, bot):
+        """Schedule a refresh of the given bot at the given time."""
+        self.schedule_cond.acquire()
+        heapq.heappush(self.schedule, (when,node,resource,bot))
+        self.schedule_cond.notify()
+        self.schedule_cond.release()
+
+    def reconfigure(self, added, removed):
+        """Start refreshing the bots added by a reload.  Removed bots are
+        dropped when they are next due."""
+        for (node,resource) in added:
+            self.jobs.put((node,resource,bots[node][resource][0]))
+
+    def work(self):
+        """Worker thread: refresh bots as they come off the job queue."""
+        while True:
+            (node,resource,bot) = self.jobs.get()
+            if not is_current(node,resource,bot):
+                self.jobs.task_done()
+                continue
+            feed = '%s/%s' % (node,resource)
+            start = time.time()
+            old = get_state(bot)
+            old.pop('update_time',None)
+            try:
+                changed = bot.refresh()
+            except:
+                metrics.incr('weatherbot_refreshes_total', feed=feed, result='error')
+                metrics.error(feed, traceback.format_exception_only(*sys.exc_info()[:2])[-1].strip())
+                next_time = time.time() + self.retry_delay
+            else:
+                if changed is not False:
+                    # only send the data out if it has actually changed
+                    new = get_state(bot)
+                    new.pop('update_time',None)
+                    changed = new != old
+                if changed:
+                    metrics.incr('weatherbot_refreshes_total', feed=feed, result='updated')
+                    # unless it was removed by a reload while refreshing
+                    if is_current(node,resource,bot):
+                        mark_updated(node,resource)
+                else:
+                    metrics.incr('weatherbot_refreshes_total', feed=feed, result='unchanged')
+                if hasattr(bot,'refresh_test'):
+                    next_time = time.time() + self.poll_delay
+                else:
+                    next_time = bot.update_time
+            metrics.observe('weatherbot_refresh_seconds', time.time() - start, feed=feed)
+            self.jobs.task_done()
+            self.schedule_refresh(next_time,node,resource,bot)
 
+    def run(self):
+        self.schedule_cond.acquire()
+        try:
+            while self.active:
+                if not self.schedule:
+                    self.schedule_cond.wait()
+                    continue
+                (when,node,resource,bot) = self.schedule[0]
+                curtime = time.time()
+                if when > curtime:
+                    self.schedule_cond.wait(when - curtime)
+                    continue
+                heapq.heappop(self.schedule)
+                if not is_current(node,resource,bot):
+                    continue
+                if hasattr(bot,'refresh_test') and not bot.refresh_test(curtime):
+                    heapq.heappush(self.schedule,
+                                   (curtime + self.poll_delay,node,resource,bot))
+                else:
+                    self.jobs.put((node,resource,bot))
+        finally:
+            self.schedule_cond.release()
+
+    def stop(self):
+        self.schedule_cond.acquire()
+        self.active = False
+        self.schedule_cond.notify()
+        self.schedule_cond.release()
+
+def shard_of(node, shards):
+    """Returns the shard that the given node belongs to.
+    """
+    return (zlib.crc32(node) & 0xffffffff) % shards
+
+def shard_options(options, shard, shards):
+    """Returns the bot options for the nodes in the given shard."""
+    return dict([((node,resource),x) for ((node,resource),x) in options.iteritems()
+                 if shard_of(node,shards) == shard])
+
+def run_shard(shard, shards, updates, controls, connection=None):
+    """Main function of a shard process.
+
+    Refreshes the bots in the shard, and puts their new state on the
+    "updates" queue for the main process, along with the options of the bot
+    that produced it.  If metrics are enabled, a snapshot of them is also
+    put there every "metrics_interval" seconds of the ShardSupervisor.  New
+    bot options from a reload arrive on the "controls" queue.  "connection" is the main process's component
+    connection, if it had connected when the shard was started.
+    """
+    global bots, bot_options, waker, bots_updated_lock
+    # reloads reach the shards through "controls", and a SIGHUP sent to the
+    # whole process group must not kill them
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # a restarted shard is forked from the running main process: close this
+    # process's copy of the component connection, and start over with fresh
+    # locks and HTTP connections, which the main process's threads may have
+    # been using
+    if connection is not None:
+        connection.Connection._sock.close()
+    bots_updated_lock = threading.Lock()
+    metrics.after_fork()
+    httppool.after_fork()
+    feeds.after_fork()
+    bots = dict([(node,x) for (node,x) in bots.iteritems()
+                 if shard_of(node,shards) == shard])
+    bot_options = shard_options(bot_options, shard, shards)
+    # don't share the main process's pipe
+    waker = Waker()
+    # bots restored from the snapshot are sent out by the main process, so
+    # only send back the ones this shard refreshes
+    take_updated()
+    updater = WeatherUpdater(workers)
+    updater.start()
+
+    def reload():
+        while True:
+            options = shard_options(controls.get(), shard, shards)
+            try:
+                (added, removed, reprioritized) = apply_bot_options(options)
+            except:
+                # leaves the bots as they were: keep taking reloads
+                metrics.error('reload', traceback.format_exception_only(*sys.exc_info()[:2])[-1].strip())
+                continue
+            updater.reconfigure(added, removed)
+    thread = threading.Thread(target=reload)
+    thread.setDaemon(True)
+    thread.start()
+
+    next_metrics = time.time()
+    while True:
+        timeout = None
+        if metrics.enabled:
+            timeout = max(0, next_metrics - time.time())
+        select.select([waker], [], [], timeout)
+        waker.clear()
+        for (node,resource) in take_updated():
+            try:
+                bot = bots[node][resource][0]
+            except KeyError:
+                # removed by a reload
+                continue
+            updates.put(('state',(node,resource,get_state(bot),
+                                  bot_options.get((node,resource)))))
+        if metrics.enabled and time.time() >= next_metrics:
+            updates.put(('metrics',('shard%d' % shard,metrics.snapshot())))
+            next_metrics = time.time() + ShardSupervisor.metrics_interval
+
+class ShardSupervisor(threading.Thread):
+    """Refresh the bots in several processes, to use more than one core.
+
+    The nodes are hash-partitioned between the shard processes, each of
+    which runs its own WeatherUpdater.  Shards send the state of updated
+    bots back over a queue; the supervisor copies it into this process's
+    bots and marks them as updated, so that the main loop sends them out.
+    Shard processes that die are restarted.  On a reload, the new bot
+    options are passed on to every shard, which applies its part of them.
+
+    The shards also send snapshots of their metrics, which are added in to
+    this process's.  The counters of a restarted shard start over.
+    """
+    # how often to check that the shard processes are still running
+    check_interval = 10
+    # how often shards send their metrics
+    metrics_interval = 10
+
+    def __init__(self, shards):
         threading.Thread.__init__(self)
         self.setDaemon(True)
 
         self.active = True
+        self.shards = shards
+        # the component connection, for restarted shards to close
+        self.connection = None
+        self.updates = multiprocessing.Queue()
+        self.processes = [None] * shards
+        self.controls = [None] * shards
+        for shard in xrange(shards):
+            self.start_shard(shard)
+
+    def start_shard(self, shard):
+        # a restarted shard starts from the current options, so it gets a
+        # new control queue rather than stale reloads
+        controls = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_shard,
+                                          args=(shard,self.shards,self.updates,controls,
+                                                self.connection))
+        process.daemon = True
+        process.start()
+        self.processes[shard] = process
+        self.controls[shard] = controls
+
+    def reconfigure(self, added, removed):
+        """Pass the options from a reload on to the shards."""
+        for controls in self.controls:
+            controls.put(bot_options)
+
+    def update(self, node, resource, state, options):
+        """Copy the state of a bot sent by a shard into this process's bot.
+        """
+        # ignore data from bots since removed or replaced by a reload
+        if same_bot(bot_options.get((node,resource)), options):
+            try:
+                set_state(bots[node][resource][0], state)
+            except KeyError:
+                pass
+            else:
+                mark_updated(node,resource)
 
     def run(self):
+        next_check = time.time() + self.check_interval
         while self.active:
-            curtime = time.time()
-            for (node,x) in bots.iteritems():
-                for (resource,y) in x.iteritems():
-                    bot = y[0]
-                    if hasattr(bot,'refresh_test'):
-                        if bot.refresh_test(curtime):
-                            try:
-                                bot.refresh()
-                                bots_updated_lock.acquire()
-                                bots_updated.add((node,resource))
-                                bots_updated_lock.release()
-                            except:
-                                pass
-                    else:
-                        if bot.update_time < curtime:
-                            try:
-                                bot.refresh()
-                                bots_updated_lock.acquire()
-                                bots_updated.add((node,resource))
-                                bots_updated_lock.release()
-                            except:
-                                pass
-            time.sleep(20)
+            try:
+                (kind,message) = self.updates.get(True, self.check_interval)
+            except Queue.Empty:
+                pass
+            else:
+                if kind == 'metrics':
+                    metrics.add_remote(*message)
+                else:
+                    self.update(*message)
+            if time.time() >= next_check:
+                for (shard,process) in enumerate(self.processes):
+                    if self.active and not process.is_alive():
+                        self.start_shard(shard)
+                next_check = time.time() + self.check_interval
+
+    def stop(self):
+        self.active = False
+        for process in self.processes:
+            process.terminate()
+
+def read_config():
+    """Returns the parsed configuration file."""
+    config = RawConfigParser()
+    config.read(['/etc/weatherbot.cfg','weatherbot.cfg'])
+    return config
+
+def read_bots(config):
+    """Returns the bot sections of the configuration, as a dictionary
+    mapping (node,resource) to the section's options."""
+    options = {}
+    for section in config.sections():
+        if section == 'weatherbot':
+            continue
+        (node,resource) = section.split('/',1)
+        options[(node,resource)] = dict(config.items(section))
+    return options
+
+def make_bot(options):
+    """Returns the (bot,priority) pair for a bot's options."""
+    return (globals()[options['class']](options), int(options['priority']))
+
+def same_bot(old, new):
+    """Returns whether two bot options only differ in their priority."""
+    if old is None or new is None:
+        return old is new
+    return dict(old, priority=None) == dict(new, priority=None)
+
+def apply_bot_options(options):
+    """Bring the bots in line with new bot options, as from read_bots.
+
+    Bots whose options have not changed are left alone, and bots whose
+    priority is the only change keep their data.  A bot whose other options
+    have changed is replaced.  Returns the lists of added, removed and
+    reprioritized (node,resource) pairs; replaced bots are in both of the
+    first two.
+
+    All the new bots are created, and all the new priorities parsed, before
+    any bot is changed, so that if one of them is invalid, the bots are left
+    as they were.
+    """
+    global bot_options
+    (added, removed, reprioritized) = ([], [], [])
+    for (key,old) in bot_options.iteritems():
+        new = options.get(key)
+        if new is None:
+            removed.append(key)
+        elif not same_bot(old,new):
+            removed.append(key)
+            added.append(key)
+        elif new != old:
+            reprioritized.append(key)
+    for key in options.iterkeys():
+        if not bot_options.has_key(key):
+            added.append(key)
+
+    created = [(key, make_bot(options[key])) for key in added]
+    priorities = [(key, int(options[key]['priority'])) for key in reprioritized]
+
+    for (node,resource) in removed:
+        del bots[node][resource]
+        if not bots[node]:
+            del bots[node]
+    for ((node,resource),x) in created:
+        bots.setdefault(node,{})[resource] = x
+    for ((node,resource),priority) in priorities:
+        bots[node][resource] = (bots[node][resource][0], priority)
+    bot_options = options
+    return (added, removed, reprioritized)
 
 # various configuration variables
 jid = ''
@@ -397,59 +2413,78 @@ server = ''
 port = 0
 password = ''
 spooldir = ''
+workers = 4
+fetch_timeout = 30
+roster_class = 'RosterStorage'
+admins = set()
+metrics_file = ''
+metrics_interval = 60
+shards = 0
+state_interval = 60
+# outgoing bytes per second (0 for no limit), and burst size
+send_rate = 0
+send_burst = 65536
 bots = {}
+# the options each bot was created from, to diff against on a reload
+bot_options = {}
 
 if __name__ == "__main__":
-    config = RawConfigParser()
-    config.read(['/etc/weatherbot.cfg','weatherbot.cfg'])
+    config = read_config()
 
     jid = config.get('weatherbot','jid')
     server = config.get('weatherbot','server')
     port = config.getint('weatherbot','port')
     password = config.get('weatherbot','password')
     spooldir = config.get('weatherbot','spooldir')
-
-    for section in config.sections():
-        if section == 'weatherbot':
-            continue
-        name, resource = section.split('/',1)
-        if not bots.has_key(name):
-            bots[name] = {}
-        options = {}
-        for (k,v) in config.items(section):
-            options[k] = v
-        bots[name][resource] = (globals()[config.get(section,'class')](options),
-                                config.getint(section,'priority'))
-
+    if config.has_option('weatherbot','workers'):
+        workers = config.getint('weatherbot','workers')
+    if config.has_option('weatherbot','timeout'):
+        fetch_timeout = config.getint('weatherbot','timeout')
+    if config.has_option('weatherbot','roster'):
+        roster_class = config.get('weatherbot','roster')
+    if config.has_option('weatherbot','admins'):
+        admins = set([x.strip() for x in config.get('weatherbot','admins').split(',')])
+    if config.has_option('weatherbot','metrics'):
+        metrics.enabled = config.getboolean('weatherbot','metrics')
+    if config.has_option('weatherbot','metrics_file'):
+        metrics_file = config.get('weatherbot','metrics_file')
+    if config.has_option('weatherbot','metrics_interval'):
+        metrics_interval = config.getint('weatherbot','metrics_interval')
+    if config.has_option('weatherbot','shards'):
+        shards = config.getint('weatherbot','shards')
+    if config.has_option('weatherbot','state_interval'):
+        state_interval = config.getint('weatherbot','state_interval')
+    if config.has_option('weatherbot','send_rate'):
+        send_rate = config.getint('weatherbot','send_rate')
+    if config.has_option('weatherbot','send_burst'):
+        send_burst = config.getint('weatherbot','send_burst')
+
+    apply_bot_options(read_bots(config))
+
+    statestore.load()
+
+    # start refreshing before connecting, so that shard processes do not
+    # inherit the connection (shards restarted later close their copy)
+    if shards:
+        updater = ShardSupervisor(shards)
+    else:
+        updater = WeatherUpdater(workers)
     weatherbot = WeatherBot()
-    updater = WeatherUpdater()
+    weatherbot.updater = updater
+    if shards:
+        updater.connection = weatherbot.conn
+    signal.signal(signal.SIGHUP, lambda signum, frame: weatherbot.request_reload())
     updater.start()
     try:
-        while True:
-            weatherbot.conn.Process(10)
-            bots_updated_lock.acquire()
-            for (node,resource) in bots_updated:
-                (bot,priority) = bots[node][resource]
-                presence = bot.presence
-                presence.setPriority(priority)
-                presence.setFrom('%s@%s/%s' % (node,jid,resource))
-                for user in weatherbot.roster[node]:
-                    presence.setTo(user)
-                    weatherbot.conn.send(presence)
-            bots_updated.clear()
-            bots_updated_lock.release()
+        weatherbot.serve()
     except:
         weatherbot.conn.UnregisterDisconnectHandler(weatherbot.conn.reconnectAndReauth)
-        updater.active = False
+        updater.stop()
 
         # send unavailable presence to all users
-        presence = xmpp.protocol.Presence(typ='unavailable')
-        for (node,x) in bots.iteritems():
-            for resource in x.iterkeys():
-                presence.setFrom('%s@%s/%s' % (node,jid,resource))
-                for user in weatherbot.roster[node]:
-                    presence.setTo(user)
-                    weatherbot.conn.send(presence)
+        weatherbot.send_unavailable()
+        weatherbot.rosterstorage.close()
+        statestore.save()
 
         # updater.join() ?
 